@@ -6,58 +6,599 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
+import arapy.corpus as corpus
+import arapy.dedup as dedup
 import arapy.normalization as norm
+import arapy.util as util
+import bz2
+import collections
+import gzip
+import multiprocessing
+import os
 import re
 import sys
 import codecs
+import time
 import xml.etree.cElementTree as etree
 
-def parse_arwiki_dump(dump_in, dump_out, split_at_punc=False, remove_non_arabic=False):
+# the markup regex strip_markup replaced, kept for benchmark comparisons
+junk_pattern = re.compile(ur"(\{\{[^}]*\}\})|(\[\[[^\]]*\]\])|(\=\=\{[^}]*\})|(\=\=[^=]*\=\=)|(<ref\b[^>]*>(.*?)</ref>)|(<ht[^>]*>)|(\[ht[^\]]*\])|(\{[^}]*\})|(<\ref>)|(<sup>)|(</sup>)|(</sub>)|(<sub>)|(</br>)|(<br>)|(<math>)|(</math>)")
+
+# punctuation removed from article text
+punctuation_pattern = re.compile(ur"[*|,\-#!<&>_+{:/$\\=()?.،'}%\";\[\]]")
+
+# rough sentence end, only matches at the end of an article
+sentence_end_pattern = re.compile(ur'[.!?]$')
+
+# every markup token strip_markup acts on, scanned for left to right
+markup_pattern = re.compile(ur"""
+      (?P<open_template>\{\{)
+    | (?P<close_template>\}\})
+    | (?P<open_table>\{\|)
+    | (?P<close_table>\|\})
+    | (?P<open_link>\[\[)
+    | (?P<close_link>\]\])
+    | (?P<open_external>\[(?:https?:|ftp:)?//[^\s\]]*)
+    | (?P<close_external>\])
+    | (?P<pipe>\|)
+    | (?P<comment><!--)
+    | (?P<tag></?(?P<name>[a-zA-Z][a-zA-Z0-9]*)\b[^<>]*?(?P<empty>/?)>)
+    | (?P<heading>^=+[^\n]*=+[ \t]*$)
+    | (?P<blank>\n[ \t]*\n)
+""", re.MULTILINE | re.UNICODE | re.VERBOSE)
+
+# the tokens that matter inside a template or table, where everything else is dropped
+template_markup_pattern = re.compile(ur"""
+      (?P<open_template>\{\{)
+    | (?P<close_template>\}\})
+    | (?P<open_table>\{\|)
+    | (?P<close_table>\|\})
+    | (?P<comment><!--)
+""", re.UNICODE | re.VERBOSE)
+
+# links that are dropped whole: files, categories and interwiki links
+dropped_link_pattern = re.compile(ur'\s*(?:file|image|category|ملف|صورة|تصنيف|[a-z]{2,3}(?:-[a-z]+)?)\s*:', re.IGNORECASE | re.UNICODE)
+
+# html tags whose content is dropped with them
+DROPPED_TAGS = frozenset(['ref', 'math', 'gallery', 'timeline', 'score', 'source', 'syntaxhighlight', 'pre', 'imagemap', 'hiero', 'chem'])
+closing_tag_patterns = dict((tag, re.compile(ur'</' + tag + ur'\s*>', re.IGNORECASE)) for tag in DROPPED_TAGS)
+
+# page header fields read before deciding whether a page gets any text work
+ns_pattern = re.compile(br'<ns>(-?\d+)</ns>')
+id_pattern = re.compile(br'<id>(\d+)</id>')
+redirect_pattern = re.compile(br'<redirect\b')
+
+# bytes of page xml handed to a worker at a time
+BATCH_BYTES = 1 << 22
+
+# compressed bytes read at a time from bz2 dumps, and of multistream dumps handed to a worker
+BZ2_BLOCK_BYTES = 1 << 20
+
+# seconds between checkpoints of a resumable run
+CHECKPOINT_SECONDS = 60
+
+# bytes per second of run time spent saving the dedup filters at checkpoints, at most;
+# checkpoints of a deduplicating run are spaced out to stay under it (8.5 minutes
+# for the default dedup_memory)
+DEDUP_SAVE_RATE = 1 << 19
+
+def parse_arwiki_dump(dump_in, dump_out, split_at_punc=False, remove_non_arabic=False, workers=1, shards=0, index=None,
+                      namespaces=(0,), redirects=False, min_length=0, compress=None, checkpoint=False,
+                      deduplicate=False, dedup_memory=dedup.MEMORY):
     """
-    Reads in an unzipped arwiki dump.
+    Reads in an arwiki dump, unzipped or compressed (.bz2 or .gz).
     Saves the text of the articles in a txt file with one sentence per line.
     returns the name of the output file
+
+    workers > 1 cleans batches of pages in a process pool, the output keeps article order
+    shards > 0 splits the output over that many files (dump_out.0, dump_out.1, ...),
+    each article going to the smallest file so far, optionally compressed ('gz' or 'bz2'),
+    and returns the name of their json manifest (see corpus.ShardedWriter)
+    index is the index file of a pages-articles-multistream dump, with it the workers
+    also decompress the dump, each taking a run of its independent bz2 streams
+
+    only pages in namespaces are kept (main articles by default, None for all),
+    redirects only if redirects is set, and only articles with at least min_length
+    chars of cleaned text; pages left out by namespace or redirect are dropped as the
+    dump is read, before batching, and get no text work
+
+    checkpoint=True saves the last finished page id, the input position and the state
+    of the output to dump_out.checkpoint.json every CHECKPOINT_SECONDS, or less often
+    when deduplicating so saving the filters stays under DEDUP_SAVE_RATE; a rerun with
+    the same arguments checks the output against it, cuts off anything written after
+    it and carries on from the next page (uncompressed output only)
+
+    deduplicate=True drops near duplicate articles and repeated lines, using about
+    dedup_memory bytes whatever the size of the dump (see dedup.Deduplicator),
+    and saves how much it removed to dump_out.dedup.json
+    """
+    if namespaces is not None:
+        namespaces = sorted(namespaces)
+
+    deduplicator = dedup.Deduplicator(dedup_memory) if deduplicate else None
+    dedup_settings = deduplicator and deduplicator.settings
+
+    kept_namespaces = namespaces and frozenset(namespaces)
+    options = (split_at_punc, remove_non_arabic, kept_namespaces, redirects, min_length, dedup_settings)
+
+    checkpoint_path = dump_out+".checkpoint.json"
+    settings = {"dump": dump_in, "index": index, "shards": shards, "compress": compress,
+                "options": [split_at_punc, remove_non_arabic, namespaces, redirects, min_length, dedup_settings]}
+
+    state = None
+    if checkpoint:
+        if compress:
+            raise ValueError("checkpoints need uncompressed output")
+
+        state = util.load_json(checkpoint_path)
+        if state and state["settings"] != settings:
+            state = None
+
+    result = dump_out+".manifest.json" if shards else dump_out
+    if state and state["complete"]:
+        return result
+
+    start = state["input"] if state else 0
+    outputs = state["output"] if state else None
+    if state and state["dedup"]:
+        deduplicator = dedup.Deduplicator(state=state["dedup"])
+
+    # input positions of the batches in flight, results come back in the same order
+    ends = collections.deque()
+
+    def tasks():
+        if index:
+            for stream_start, end in multistream_ranges(dump_in, index):
+                if end > start:
+                    ends.append(end)
+                    yield (dump_in, stream_start, end, options)
+        else:
+            pages = filter_pages(iter_pages(dump_lines(dump_in, start), start), kept_namespaces, redirects)
+            for end, pages in iter_page_batches(pages, BATCH_BYTES):
+                ends.append(end)
+                yield (pages, options)
+
+    # only checkpoints and shard manifests need the sha1 and counts of a TrackedFile
+    if shards:
+        writer = corpus.ShardedWriter(dump_out, shards, compress, outputs)
+    elif checkpoint:
+        writer = corpus.TrackedFile(dump_out, state=outputs and outputs[0])
+    else:
+        writer = open(dump_out, 'wb')
+
+    interval = CHECKPOINT_SECONDS
+    if deduplicator:
+        filter_bytes = deduplicator.lines.array.nbytes + deduplicator.articles.array.nbytes
+        interval = max(interval, float(filter_bytes) / DEDUP_SAVE_RATE)
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    try:
+        results = util.ordered_map(pool, _clean_streams if index else _clean_pages, tasks(), workers * 2)
+
+        position = start
+        saved = time.time()
+        for cleaned in results:
+            position = ends.popleft()
+
+            for page_id, text, band_keys in cleaned:
+                if deduplicator:
+                    text = deduplicator.filter(text, band_keys)
+                writer.write(text)
+
+            if checkpoint and cleaned and time.time() - saved >= interval:
+                writer.flush()
+                _save_checkpoint(checkpoint_path, settings, cleaned[-1][0], position, writer, deduplicator, False)
+                saved = time.time()
+
+        writer.flush()
+        if deduplicator:
+            dedup.save_report(deduplicator, dump_out+".dedup.json")
+        if checkpoint:
+            _save_checkpoint(checkpoint_path, settings, None, position, writer, deduplicator, True)
+    finally:
+        writer.close()
+        if pool:
+            pool.close()
+            pool.join()
+
+    return result
+
+def _save_checkpoint(path, settings, page_id, end, writer, deduplicator, complete):
+    """
+    atomically records how far a parse_arwiki_dump run got
+    the dedup filters go to a new file per checkpoint, the previous one is removed
+    once the checkpoint no longer points to it
+    """
+    outputs = writer.state()
+    if not isinstance(outputs, list):
+        outputs = [outputs]
+
+    previous = util.load_json(path)
+    filters = None
+    if deduplicator and not complete:
+        filters = deduplicator.save(path[:-len(".checkpoint.json")]+".dedup."+str(end)+".npz")
+
+    util.save_json({"settings": settings, "page_id": page_id, "input": end,
+                    "output": outputs, "dedup": filters, "complete": complete}, path)
+
+    if previous and previous.get("dedup") and previous["dedup"] != filters and os.path.exists(previous["dedup"]):
+        os.remove(previous["dedup"])
+
+def clean_text(text, split_at_punc=False, remove_non_arabic=False):
+    """ strips markup and punctuation from article text, returns its non-empty lines """
+    text = strip_markup(text)
+
+    if remove_non_arabic:
+        text = norm.normalize_charset(text)
+
+    # move each sentence to a new line (rough regex)
+    if split_at_punc:
+        text = sentence_end_pattern.sub('\n', text)
+
+    text = punctuation_pattern.sub('', text)
+
+    return [line for line in text.split('\n') if line.strip() != '']
+
+def dump_lines(path, start=0):
+    """
+    yields the lines of a dump file, decompressing .bz2 (including multistream) and .gz dumps
+    start skips to a line starting at that (uncompressed) byte offset
+    """
+    if path.endswith('.bz2') or path.endswith('.gz'):
+        if path.endswith('.bz2'):
+            infile = open(path, 'rb')
+            lines = iter_lines(iter_bz2_streams(infile))
+        else:
+            infile = gzip.open(path, 'rb')
+            lines = infile
+
+        with infile:
+            position = 0
+            for line in lines:
+                if position >= start:
+                    yield line
+                position += len(line)
+
+    else:
+        with open(path, 'rb') as infile:
+            infile.seek(start)
+            for line in infile:
+                yield line
+
+def iter_bz2_streams(infile, end=None):
+    """
+    Yields the decompressed data of an open bz2 file up to byte offset end
+    Continues through concatenated streams, which bz2.BZ2File stops at
+    """
+    decompressor = bz2.BZ2Decompressor()
+    position = infile.tell()
+
+    while end is None or position < end:
+        size = BZ2_BLOCK_BYTES if end is None else min(BZ2_BLOCK_BYTES, end - position)
+        data = infile.read(size)
+        if not data:
+            break
+        position += len(data)
+
+        while data:
+            try:
+                yield decompressor.decompress(data)
+            except EOFError:
+                # the last stream ended exactly at the end of the previous read
+                decompressor = bz2.BZ2Decompressor()
+                continue
+
+            # anything past the end of a stream starts the next one
+            data = decompressor.unused_data
+            if data:
+                decompressor = bz2.BZ2Decompressor()
+
+def iter_lines(chunks):
+    """ yields the lines of a stream given as an iterable of byte chunks """
+    tail = b''
+
+    for chunk in chunks:
+        lines = (tail + chunk).split(b'\n')
+        tail = lines.pop()
+        for line in lines:
+            yield line + b'\n'
+
+    if tail:
+        yield tail
+
+def multistream_ranges(dump_in, index):
+    """
+    Reads the index of a multistream dump (offset:page id:title lines, plain or .bz2)
+    returns (start, end) byte ranges of its page streams, grouped to about BZ2_BLOCK_BYTES
+    """
+    offsets = set()
+    for line in dump_lines(index):
+        if line.strip():
+            offsets.add(int(line.split(b':', 1)[0]))
+
+    # the streams run from each offset to the next, the last one to the end of the dump
+    bounds = sorted(offsets) + [os.path.getsize(dump_in)]
+
+    ranges = []
+    start = bounds[0]
+    for end in bounds[1:]:
+        if end - start >= BZ2_BLOCK_BYTES:
+            ranges.append((start, end))
+            start = end
+    if bounds[-1] > start:
+        ranges.append((start, bounds[-1]))
+
+    return ranges
+
+def _unclose_links(out, stack):
+    """ pops the links left open on top of the stack, putting their brackets back as text """
+    brackets = []
+    while stack and stack[-1][0] in ('open_link', 'dropped_link', 'open_external'):
+        kind, start, display, opener, newline = stack.pop()
+        if kind != 'open_external':
+            brackets.append((start, opener.group()))
+
+    # spliced in one go, the innermost link comes first off the stack
+    pieces = []
+    previous = 0
+    for start, bracket in reversed(brackets):
+        pieces.extend(out[previous:start])
+        pieces.append(bracket)
+        previous = start
+    if brackets:
+        out[:] = pieces + out[previous:]
+
+def strip_markup(text):
+    """
+    Removes wiki markup from article text in one left to right pass
+    Drops templates and tables (nested ones too), refs, math and similar blocks,
+    comments, headings, files and categories, and html tags
+    Keeps the display text of wiki links and external links
+    Openers left unclosed (at the end of the text, or for links at a blank line
+    or heading) are kept as text, with the text after them
+    """
+    out = []
+
+    # open templates, tables and links, with where their text starts in out,
+    # where the display text of a link starts, the match that opened them
+    # and for links the first newline after the opener
+    stack = []
+    templates = 0
+
+    # where templates and tables found to be left open start, they are kept as text
+    unclosed = set()
+
+    # per dropped tag name, an offset past which the tag has no closer
+    no_closer = {}
+
+    # the first newline at or after newline_from, looked up again only once passed
+    newline_from = newline = -1
+
+    position = 0
+    while True:
+        if templates:
+            match = template_markup_pattern.search(text, position)
+        else:
+            match = markup_pattern.search(text, position)
+
+        if match is None:
+            if templates:
+                # scan again from the outermost template or table left open,
+                # keeping it and all those inside as text
+                index = next(i for i, entry in enumerate(stack) if entry[0] in ('open_template', 'open_table'))
+                unclosed.update(entry[3].start() for entry in stack[index:])
+                position = stack[index][3].start()
+                del stack[index:]
+                templates = 0
+                continue
+
+            out.append(text[position:])
+            _unclose_links(out, stack)
+            break
+
+        if not templates and match.start() > position:
+            out.append(text[position:match.start()])
+        position = match.end()
+
+        token = match.lastgroup
+        top = stack[-1][0] if stack else None
+        literal = False
+        pipe = False
+
+        if token == 'open_template' or token == 'open_table':
+            if match.start() in unclosed:
+                literal = True
+            else:
+                stack.append((token, len(out), len(out), match, None))
+                templates += 1
+
+        elif token == 'close_template' or token == 'close_table':
+            opening = 'open_template' if token == 'close_template' else 'open_table'
+
+            if token == 'close_table' and top != opening:
+                # the end of a template parameter, like {{name|}}
+                position = match.start() + 1
+                pipe = True
+
+            elif any(entry[0] == opening for entry in stack):
+                # close the block along with anything left open inside it
+                while True:
+                    kind = stack.pop()[0]
+                    if kind in ('open_template', 'open_table'):
+                        templates -= 1
+                    if kind == opening:
+                        break
+            else:
+                literal = True
+
+        elif token == 'open_link':
+            if not newline_from <= position <= newline:
+                newline_from = position
+                newline = text.find(u'\n', position)
+                if newline < 0:
+                    newline = len(text)
+
+            kind = 'dropped_link' if dropped_link_pattern.match(text, position) else 'open_link'
+            stack.append((kind, len(out), len(out), match, newline))
+
+        elif token == 'close_link':
+            if top in ('open_link', 'dropped_link'):
+                kind, start, display, opener, first_newline = stack.pop()
+                if kind == 'dropped_link':
+                    del out[start:]
+                else:
+                    del out[start:display]
+            else:
+                literal = True
+
+        elif token == 'open_external':
+            # the url is dropped, any text after it is kept
+            stack.append(('open_external', len(out), len(out), match, None))
+
+        elif token == 'close_external':
+            if top == 'open_external':
+                stack.pop()
+            else:
+                literal = True
+
+        elif token == 'pipe':
+            pipe = True
+
+        elif token == 'comment':
+            end = text.find('-->', position)
+            position = len(text) if end < 0 else end + 3
+
+        elif token == 'tag':
+            name = match.group('name').lower()
+            if name in DROPPED_TAGS and not match.group().startswith('</') and not match.group('empty'):
+                # a closer missing past one offset is missing past any later one too
+                closing = None
+                if position < no_closer.get(name, len(text) + 1):
+                    closing = closing_tag_patterns[name].search(text, position)
+                if closing:
+                    position = closing.end()
+                else:
+                    no_closer[name] = min(position, no_closer.get(name, position))
+
+        elif token == 'heading' or token == 'blank':
+            # links do not run past a paragraph, headings are dropped
+            _unclose_links(out, stack)
+            literal = token == 'blank'
+
+        if pipe:
+            # only the text after the last pipe of a link on its first line is displayed,
+            # it replaces the text before once the link closes
+            if top in ('open_link', 'dropped_link') and match.start() < stack[-1][4]:
+                out.append(u'|')
+                stack[-1] = stack[-1][:2] + (len(out),) + stack[-1][3:]
+            else:
+                literal = True
+
+        if literal and not templates:
+            out.append(text[match.start():position])
+
+    return u''.join(out)
+
+def iter_pages(lines, position=0):
+    """
+    Yields (end, page) for each <page> element of a dump, from an iterable of its lines
+    page is the raw xml of the element, end is the byte offset just past it
+    position is the offset of the first line
+    """
+    page = None
+
+    for line in lines:
+        position += len(line)
+        tag = line.strip()
+
+        if page is None:
+            if tag == b'<page>':
+                page = [line]
+        else:
+            page.append(line)
+            if tag == b'</page>':
+                yield position, b''.join(page)
+                page = None
+
+def iter_page_batches(pages, batch_bytes=BATCH_BYTES):
+    """ groups the (end, page) pairs of iter_pages into (end, pages) of about batch_bytes """
+    batch = []
+    size = 0
+    end = 0
+
+    for end, page in pages:
+        batch.append(page)
+        size += len(page)
+
+        if size >= batch_bytes:
+            yield end, batch
+            batch = []
+            size = 0
+
+    if batch:
+        yield end, batch
+
+def keep_page(page, namespaces=frozenset([0]), redirects=False):
+    """ checks the namespace and redirect of a page from its raw xml header """
+    header = page[:page.find(b'<revision')]
+
+    if namespaces is not None:
+        match = ns_pattern.search(header)
+        if match is None or int(match.group(1)) not in namespaces:
+            return False
+
+    if not redirects and redirect_pattern.search(header):
+        return False
+
+    return True
+
+def filter_pages(pages, namespaces=frozenset([0]), redirects=False):
+    """ yields the (end, page) pairs of iter_pages for the pages keep_page keeps """
+    for end, page in pages:
+        if keep_page(page, namespaces, redirects):
+            yield end, page
+
+def _clean_pages(args):
+    """
+    pool worker, returns (page id, utf8 text lines, lsh band keys) for each page xml of a batch
+    the pages are already filtered by filter_pages, those too short get empty text,
+    band keys are None unless deduplicating
     """
-    # text tag that wiki uses to identify text content blocks
-    text_tag = '{http://www.mediawiki.org/xml/export-0.10/}text'
-    junkPattern = ur"(\{\{[^}]*\}\})|(\[\[[^\]]*\]\])|(\=\=\{[^}]*\})|(\=\=[^=]*\=\=)|(<ref\b[^>]*>(.*?)</ref>)|(<ht[^>]*>)|(\[ht[^\]]*\])|(\{[^}]*\})|(<\ref>)|(<sup>)|(</sup>)|(</sub>)|(<sub>)|(</br>)|(<br>)|(<math>)|(</math>)"
-    punctuationPattern = ur"[*|,\-#!<&>_+{:/$\\=()?.،'}%\";\[\]]"
+    pages, (split_at_punc, remove_non_arabic, namespaces, redirects, min_length, hasher) = args
+
+    if hasher:
+        hasher = dedup.MinHasher(hasher["bands"], hasher["rows"], hasher["shingle"])
 
-    with open(dump_in, 'r') as infile:
-        with open(dump_out, 'w') as outfile:
+    cleaned = []
+    for page in pages:
+        # the first id of a page, ahead of its revision, is the page id
+        page_id = id_pattern.search(page).group(1)
 
-            # iterate through the xml tree looking for tag starts
-            context = etree.iterparse(infile, events = ('start','end'))
-            context = iter(context)
-            event, root = context.next()
+        text = etree.fromstring(page).findtext('revision/text')
 
-            for event, elem in context:
+        # some text tags are empty, cleaning only shortens text
+        if not text or len(text) < min_length:
+            cleaned.append((page_id, b'', None))
+            continue
 
-                # if the tag matches the wiki tag for text content, we extract the text
-                if event == 'end' and elem.tag == text_tag:
+        lines = clean_text(text, split_at_punc, remove_non_arabic)
 
-                    text = elem.text
-                    #print(text)
-                    
-                    # some text tags are empty
-                    if text:
-                    
-                        text = re.sub(junkPattern, '', text)
+        if min_length and sum(len(line) for line in lines) < min_length:
+            lines = []
 
-                        if remove_non_arabic:
-                            text = norm.normalize_charset(text)
-                        
-                        # move each sentence to a new line (rough regex)
-                        if split_at_punc:
-                            text = re.sub(ur'[.!?]$', '\n', text)
+        text = u''.join(line + u'\n' for line in lines)
+        cleaned.append((page_id, text.encode('utf8'), hasher and hasher.band_keys(text)))
 
-                        text = re.sub(punctuationPattern, '', text)
+    return cleaned
 
-                        for line in text.split('\n'):
-                            if line.strip() != '':
-                                outfile.write((line+'\n').encode('utf8'))
+def _clean_streams(args):
+    """ pool worker, decompresses a byte range of bz2 streams and cleans its pages """
+    dump_in, start, end, options = args
+    namespaces, redirects = options[2:4]
 
-                    # keep memory free of previous branches of the xml tree
-                    root.clear()
+    with open(dump_in, 'rb') as infile:
+        infile.seek(start)
+        pages = iter_pages(iter_lines(iter_bz2_streams(infile, end)))
+        pages = [page for page_end, page in filter_pages(pages, namespaces, redirects)]
 
-    return dump_out
\ No newline at end of file
+    return _clean_pages((pages, options))
@@ -0,0 +1,239 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+### Purpose: Benchmarks for arapy text processing, with a synthetic arabic corpus generator
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import arapy
+import arapy.arwiki as arwiki
+import arapy.madamira as madamira
+import arapy.normalization as norm
+import itertools
+import json
+import os
+import random
+import re
+import requests
+import subprocess
+import tempfile
+import time
+import xml.etree.cElementTree as etree
+
+# arabic letters, hamza through yaa
+LETTERS = [unichr(c) for c in range(0x0621, 0x063b) + range(0x0641, 0x064b)]
+DIACRITICS = list(norm.HARAKAT + norm.TANWIN + norm.SHADDAH)
+ASCII_DIGITS = u'0123456789'
+INDIC_DIGITS = u'٠١٢٣٤٥٦٧٨٩'
+LATIN = u'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ'
+
+# markup that should not survive article cleaning
+leftover_markup_pattern = re.compile(ur'\{\{|\}\}|\[\[|\]\]|</?ref\b|\{\||\|\}|<!--')
+
+# madamira request configs compared by benchmark_madamira_configs, None is the full config
+MADAMIRA_CONFIGS = [("full", None), ("transform", madamira.TRANSFORM_FEATURES),
+                    ("lemma", ("lemma",)), ("pos", ("pos",)), ("tokens", ("tokens",))]
+
+# functions timed on each line of the corpus
+LINE_FUNCTIONS = ["normalize", "normalize_charset", "normalize_digits", "normalize_alif",
+                  "normalize_hamza", "normalize_yaa", "remove_tashkil", "remove_harakat",
+                  "remove_tanwin", "remove_shaddah", "remove_kashida"]
+
+def synthetic_lines(lines=100000, seed=0, diacritic_density=0.3, digit_ratio=0.05, latin_ratio=0.05,
+                    kashida_ratio=0.01, mean_words=12, length_sigma=0.75):
+    """
+    Yields reproducible lines of synthetic arabic text
+    diacritic_density is the chance of a diacritic after each letter
+    digit_ratio and latin_ratio are the shares of number and latin noise words
+    line lengths in words are lognormal around mean_words, spread by length_sigma
+    """
+    rand = random.Random(seed)
+
+    for _ in range(lines):
+        words = []
+        for _ in range(max(1, int(rand.lognormvariate(0, length_sigma) * mean_words))):
+            kind = rand.random()
+
+            if kind < digit_ratio:
+                digits = ASCII_DIGITS if rand.random() < 0.5 else INDIC_DIGITS
+                words.append(u''.join(rand.choice(digits) for _ in range(rand.randint(1, 4))))
+
+            elif kind < digit_ratio + latin_ratio:
+                words.append(u''.join(rand.choice(LATIN) for _ in range(rand.randint(2, 8))))
+
+            else:
+                word = []
+                for _ in range(rand.randint(2, 7)):
+                    word.append(rand.choice(LETTERS))
+                    if rand.random() < diacritic_density:
+                        word.append(rand.choice(DIACRITICS))
+                    if rand.random() < kashida_ratio:
+                        word.append(norm.KASHIDA)
+                words.append(u''.join(word))
+
+        yield u' '.join(words)
+
+def synthetic_corpus(path, lines=100000, seed=0, **options):
+    """ writes a synthetic corpus file, takes the synthetic_lines options, returns the file name """
+    return norm.write_lines(synthetic_lines(lines, seed, **options), path)
+
+def best_time(function, repeat=3):
+    """ returns the fastest wall time in seconds of repeat calls to function """
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        function()
+        elapsed = time.time() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+def _rates(seconds, size, lines):
+    return {"seconds": seconds, "mb_per_s": size / seconds / 1e6, "lines_per_s": lines / seconds}
+
+def benchmark_normalization(lines=100000, seed=0, repeat=3, **options):
+    """
+    Times the normalization and transliteration functions on a synthetic corpus
+    String functions are called once per line, file functions run on the whole corpus
+    returns a dict of benchmark name to seconds, MB/s and lines/s
+    """
+    corpus = list(synthetic_lines(lines, seed, **options))
+    size = sum(len(line.encode('utf8')) + 1 for line in corpus)
+    results = {}
+
+    for name in LINE_FUNCTIONS:
+        function = getattr(norm, name)
+        results[name] = _rates(best_time(lambda: [function(line) for line in corpus], repeat), size, lines)
+
+    bw_corpus = [norm.unicode_to_bw(line) for line in corpus]
+    results["unicode_to_bw"] = _rates(best_time(lambda: [norm.unicode_to_bw(line) for line in corpus], repeat), size, lines)
+    results["bw_to_unicode"] = _rates(best_time(lambda: [norm.unicode_to_bw(line, 1) for line in bw_corpus], repeat), size, lines)
+
+    words = [word for line in corpus for word in line.split()]
+    results["normalize_batch (words)"] = _rates(best_time(lambda: norm.normalize_batch(words), repeat), size, lines)
+
+    directory = tempfile.mkdtemp()
+    try:
+        infile = norm.write_lines(corpus, os.path.join(directory, "corpus.txt"))
+        outfile = os.path.join(directory, "normal.txt")
+
+        results["normalize_sentence_file (lines)"] = _rates(
+            best_time(lambda: norm.normalize_sentence_file(infile, outfile, block_size=0), repeat), size, lines)
+        results["normalize_sentence_file (blocks)"] = _rates(
+            best_time(lambda: norm.normalize_sentence_file(infile, outfile), repeat), size, lines)
+        results["transliterate_file"] = _rates(
+            best_time(lambda: norm.transliterate_file(infile, outfile), repeat), size, lines)
+    finally:
+        for name in os.listdir(directory):
+            os.remove(os.path.join(directory, name))
+        os.rmdir(directory)
+
+    return results
+
+def benchmark_markup(dump_in, pages=1000, repeat=3):
+    """
+    Times the markup scanner against the old junk regex on the first articles of a dump
+    Also counts the markup tokens each leaves behind
+    returns a dict of cleaner name to seconds, MB/s, articles/s and leftover markup
+    """
+    articles = []
+    for end, page in itertools.islice(arwiki.iter_pages(arwiki.dump_lines(dump_in)), pages):
+        text = etree.fromstring(page).findtext('revision/text')
+        if text:
+            articles.append(text)
+
+    size = sum(len(article.encode('utf8')) for article in articles)
+    cleaners = {"junk_pattern": lambda text: arwiki.junk_pattern.sub('', text),
+                "strip_markup": arwiki.strip_markup}
+
+    results = {}
+    for name, cleaner in cleaners.iteritems():
+        seconds = best_time(lambda: [cleaner(article) for article in articles], repeat)
+        leftover = sum(len(leftover_markup_pattern.findall(cleaner(article))) for article in articles)
+
+        results[name] = _rates(seconds, size, len(articles))
+        results[name]["articles_per_s"] = results[name].pop("lines_per_s")
+        results[name]["leftover_markup"] = leftover
+
+    return results
+
+def benchmark_madamira_configs(sentences=1000, port=madamira.MADAPORT, repeat=3, seed=0, configs=MADAMIRA_CONFIGS):
+    """
+    Times one request of synthetic sentences to a running madamira server per
+    request config (see madamira.request_prefix)
+    returns a dict of config name to request and response bytes, seconds and sentences/s
+    """
+    batch = [line.encode('utf8') for line in synthetic_lines(sentences, seed)]
+    session = requests.Session()
+    url = "http://localhost:" + str(port)
+    results = {}
+
+    try:
+        for name, features in configs:
+            query = madamira.Madamira.query(batch, prefix=madamira.request_prefix(features))
+            response = []
+
+            def request():
+                response[:] = [session.post(url, headers=madamira.Madamira.headers, data=query).content]
+
+            seconds = best_time(request, repeat)
+            results[name] = {"request_bytes": len(query), "response_bytes": len(response[0]),
+                             "seconds": seconds, "sentences_per_s": sentences / seconds}
+    finally:
+        session.close()
+
+    return results
+
+def current_commit():
+    """ returns the git commit of the arapy checkout, or 'unknown' """
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(arapy.__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def save_results(results, path="benchmarks.json", label=None):
+    """
+    Appends a benchmark run to a json history file, labeled with the git commit by default
+    returns the file name
+    """
+    history = []
+    if os.path.exists(path):
+        with open(path, 'r') as infile:
+            history = json.load(infile)
+
+    history.append({"label": label or current_commit(), "time": time.time(), "results": results})
+
+    with open(path, 'w') as outfile:
+        json.dump(history, outfile, indent=2, sort_keys=True)
+
+    return path
+
+def compare_results(path="benchmarks.json", base=-2, head=-1):
+    """
+    Prints the throughput of two runs in a history file and their ratio
+    base and head are run labels or positions in the history, the last two by default
+    """
+    with open(path, 'r') as infile:
+        history = json.load(infile)
+
+    def find(run):
+        if isinstance(run, int):
+            return history[run]
+        return [entry for entry in history if entry["label"] == run][-1]
+
+    base, head = find(base), find(head)
+
+    print("{0:<36}{1:>14}{2:>14}{3:>9}".format("benchmark", base["label"], head["label"], "ratio"))
+    for name in sorted(head["results"]):
+        if name in base["results"]:
+            before = base["results"][name]["mb_per_s"]
+            after = head["results"][name]["mb_per_s"]
+            print("{0:<36}{1:>14.2f}{2:>14.2f}{3:>9.2f}".format(name, before, after, after / before))
+
+if __name__ == "__main__":
+    results = benchmark_normalization()
+    for name in sorted(results):
+        print("{0:<36}{1:>10.2f} MB/s{2:>12.0f} lines/s".format(name, results[name]["mb_per_s"], results[name]["lines_per_s"]))
+    save_results(results)
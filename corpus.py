@@ -0,0 +1,268 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+### Purpose: Corpus storage tools, integer id corpora and sharded text corpora
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import arapy.normalization as norm
+import bz2
+import gzip
+import hashlib
+import json
+import numpy as np
+import os
+
+# token ids buffered in memory before each write, and remapped per step
+ID_BUFFER = 1 << 22
+
+# sentences decoded per read when iterating a corpus
+SENTENCE_BUFFER = 1 << 16
+
+def build_corpus(sentences, prefix="corpus"):
+    """
+    Tokenizes sentences on whitespace and saves them as integer ids
+    sentences is a sentence file path, or an iterable of lines such as
+    normalization.Pipeline("wiki.txt", normalization.normalize_lines)
+    Writes prefix.vocab (word and count per line in id order, most frequent first),
+    prefix.ids (uint32 token ids) and prefix.offsets (uint64 offset of each sentence
+    into the ids, plus the end of the last one)
+    Empty sentences are kept, so sentence numbers match line numbers
+    returns the prefix
+    """
+    if isinstance(sentences, basestring):
+        sentences = norm.read_lines(sentences)
+
+    vocab = {}
+    counts = []
+    written = 0
+
+    with open(prefix+".ids", 'wb') as ids_file:
+        with open(prefix+".offsets", 'wb') as offsets_file:
+            ids = []
+            offsets = [0]
+
+            for sentence in sentences:
+                for word in sentence.split():
+                    index = vocab.get(word)
+                    if index is None:
+                        index = vocab[word] = len(counts)
+                        counts.append(0)
+                    counts[index] += 1
+                    ids.append(index)
+
+                offsets.append(written + len(ids))
+
+                if len(ids) >= ID_BUFFER:
+                    np.array(ids, dtype=np.uint32).tofile(ids_file)
+                    np.array(offsets, dtype=np.uint64).tofile(offsets_file)
+                    written += len(ids)
+                    ids = []
+                    offsets = []
+
+            np.array(ids, dtype=np.uint32).tofile(ids_file)
+            np.array(offsets, dtype=np.uint64).tofile(offsets_file)
+            written += len(ids)
+
+    # renumber the ids by descending frequency, ties keep first appearance order
+    counts = np.array(counts, dtype=np.int64)
+    order = np.argsort(-counts, kind='mergesort')
+    renumber = np.empty(len(order), dtype=np.uint32)
+    renumber[order] = np.arange(len(order), dtype=np.uint32)
+
+    if written:
+        ids = np.memmap(prefix+".ids", dtype=np.uint32, mode='r+')
+        for start in xrange(0, written, ID_BUFFER):
+            ids[start:start + ID_BUFFER] = renumber[ids[start:start + ID_BUFFER]]
+        ids.flush()
+        del ids
+
+    words = [None] * len(order)
+    for word, index in vocab.iteritems():
+        words[renumber[index]] = word
+
+    with open(prefix+".vocab", 'wb') as vocab_file:
+        for word, count in zip(words, counts[order].tolist()):
+            vocab_file.write((word + u'\t' + unicode(count) + u'\n').encode('utf8'))
+
+    return prefix
+
+class Corpus:
+    """
+    Integer id corpus saved by build_corpus, with the ids memory mapped
+    Iterating yields each sentence as a list of words, so a Corpus can be passed
+    straight to word2vec.train_embeddings
+    """
+    def __init__(self, prefix="corpus"):
+        self.prefix = prefix
+
+        self.words = []
+        counts = []
+        with open(prefix+".vocab", 'rb') as vocab_file:
+            for line in vocab_file:
+                word, count = line.decode('utf8').rstrip(u'\n').split(u'\t')
+                self.words.append(word)
+                counts.append(int(count))
+
+        self.counts = np.array(counts, dtype=np.int64)
+        self.vocab = dict((word, index) for index, word in enumerate(self.words))
+
+        self.offsets = np.fromfile(prefix+".offsets", dtype=np.uint64)
+
+        # numpy can't map an empty file
+        if self.offsets[-1]:
+            self.ids = np.memmap(prefix+".ids", dtype=np.uint32, mode='r')
+        else:
+            self.ids = np.zeros(0, dtype=np.uint32)
+
+    def __len__(self):
+        """ number of sentences """
+        return len(self.offsets) - 1
+
+    def tokens(self):
+        """ number of tokens """
+        return int(self.offsets[-1])
+
+    def sentence_ids(self, index):
+        """ returns the token ids of one sentence """
+        return self.ids[self.offsets[index]:self.offsets[index + 1]]
+
+    def sentence(self, index):
+        """ returns one sentence as a list of words """
+        return [self.words[i] for i in self.sentence_ids(index).tolist()]
+
+    def __iter__(self):
+        words = self.words
+
+        for first in xrange(0, len(self), SENTENCE_BUFFER):
+            offsets = self.offsets[first:first + SENTENCE_BUFFER + 1].tolist()
+            base = offsets[0]
+            ids = self.ids[base:offsets[-1]].tolist()
+
+            for start, end in zip(offsets, offsets[1:]):
+                yield [words[i] for i in ids[start - base:end - base]]
+
+class TrackedFile:
+    """
+    Output file that keeps count of the lines, bytes (uncompressed) and tokens written
+    to it, and of their sha1
+    Given a state() saved earlier it reopens the file at that point: the content up to
+    there is checked against the recorded sha1 and anything after it is cut off
+    """
+    def __init__(self, path, compress=None, state=None):
+        self.path = path
+        self.sha1 = hashlib.sha1()
+        self.lines = 0
+        self.bytes = 0
+        self.tokens = 0
+
+        if state:
+            if compress:
+                raise ValueError("compressed files can't be reopened: "+path)
+
+            self.file = open(path, 'r+b')
+
+            remaining = state["bytes"]
+            while remaining:
+                data = self.file.read(min(remaining, 1 << 22))
+                if not data:
+                    break
+                self.sha1.update(data)
+                remaining -= len(data)
+
+            if remaining or self.sha1.hexdigest() != state["sha1"]:
+                self.file.close()
+                raise ValueError(path+" does not match its saved state")
+
+            self.file.truncate(state["bytes"])
+            self.file.seek(state["bytes"])
+
+            self.lines = state["lines"]
+            self.bytes = state["bytes"]
+            self.tokens = state["tokens"]
+
+        elif compress == 'gz':
+            self.file = gzip.open(path, 'wb')
+        elif compress == 'bz2':
+            self.file = bz2.BZ2File(path, 'wb')
+        else:
+            self.file = open(path, 'wb')
+
+    def write(self, text):
+        """ writes utf8 text made of whole lines """
+        self.file.write(text)
+        self.sha1.update(text)
+        self.lines += text.count(b'\n')
+        self.bytes += len(text)
+        self.tokens += len(text.split())
+
+    def flush(self):
+        """ pushes everything written so far to disk, compressed files only on close """
+        if isinstance(self.file, file):
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def state(self):
+        return {"path": self.path, "lines": self.lines, "bytes": self.bytes,
+                "tokens": self.tokens, "sha1": self.sha1.hexdigest()}
+
+    def close(self):
+        """ closes the file, returns its name """
+        self.file.close()
+        return self.path
+
+class ShardedWriter:
+    """
+    Writes lines of text over several shard files, each write going to the shard
+    with the fewest bytes so far, so shards stay balanced in size
+    Shards are prefix.0, prefix.1, ... with .gz or .bz2 added when compressed
+    close() saves a json manifest to prefix.manifest.json, with the lines, bytes
+    (uncompressed), tokens and sha1 of each shard
+    states reopens uncompressed shards from an earlier state(), see TrackedFile
+    """
+    def __init__(self, prefix, shards, compress=None, states=None):
+        self.prefix = prefix
+        self.compress = compress
+        self.shards = []
+
+        for i in range(shards):
+            path = prefix+"."+str(i)
+            if compress:
+                path += "."+compress
+
+            self.shards.append(TrackedFile(path, compress, states[i] if states else None))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def write(self, text):
+        """ writes utf8 text made of whole lines to the smallest shard """
+        if text:
+            min(self.shards, key=lambda shard: shard.bytes).write(text)
+
+    def flush(self):
+        for shard in self.shards:
+            shard.flush()
+
+    def state(self):
+        return [shard.state() for shard in self.shards]
+
+    def close(self):
+        """ closes the shards and saves the manifest, returns the manifest name """
+        for shard in self.shards:
+            shard.close()
+
+        manifest_path = self.prefix+".manifest.json"
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump({"compress": self.compress, "shards": self.state()}, manifest_file, indent=2)
+
+        return manifest_path
+
+def shard_paths(manifest_path):
+    """ returns the shard file names listed in a ShardedWriter manifest """
+    with open(manifest_path, 'r') as manifest_file:
+        return [shard["path"] for shard in json.load(manifest_file)["shards"]]
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+### Purpose: Bounded memory duplicate removal, bloom filters for lines and minhash lsh for articles
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import hashlib
+import json
+import math
+import numpy as np
+import zlib
+
+# default memory for the filters of a Deduplicator, in bytes
+MEMORY = 1 << 28
+
+# sizes of the full arwiki dump the filters are made for: lines of cleaned text,
+# and articles (each adding one key per lsh band)
+EXPECTED_LINES = 1 << 25
+EXPECTED_ARTICLES = 1 << 21
+
+# share of the memory given to the line filter
+LINE_SHARE = 0.75
+
+# minhash signatures are bands * rows values; articles sharing all rows of any band
+# count as near duplicates, which happens mostly above a jaccard similarity of
+# about (1 / bands) ** (1 / rows), 0.7 for the defaults
+BANDS = 16
+ROWS = 8
+
+# words per shingle
+SHINGLE = 3
+
+# shingles hashed per step of minhashing, bounds its memory on long articles
+SHINGLE_BUFFER = 1 << 12
+
+# modulus of the minhash permutations, a mersenne prime
+MERSENNE_61 = np.uint64((1 << 61) - 1)
+
+class BloomFilter:
+    """
+    Bloom filter over 128 bit keys, given as rows of two uint64
+    bits is the filter size, hashes the number of bits set per key
+    """
+    def __init__(self, bits, hashes, array=None, count=0):
+        self.size = (bits + 7) // 8 * 8
+        self.hashes = hashes
+        self.array = np.zeros(self.size // 8, dtype=np.uint8) if array is None else array
+        self.count = count
+        self.steps = np.arange(hashes, dtype=np.uint64)
+
+    def _positions(self, keys):
+        # double hashing, bit i of a key is h1 + i * h2
+        with np.errstate(over='ignore'):
+            return (keys[:, :1] + keys[:, 1:] * self.steps) % np.uint64(self.size)
+
+    def check_add(self, keys):
+        """
+        adds keys, returns a bool array of which were (probably) added before
+        keys are assumed distinct
+        """
+        if not len(keys):
+            return np.zeros(0, dtype=bool)
+
+        positions = self._positions(keys)
+        index = (positions >> np.uint64(3)).astype(np.intp)
+        mask = np.left_shift(1, (positions & np.uint64(7)).astype(np.uint8)).astype(np.uint8)
+
+        seen = ((self.array[index] & mask) != 0).all(axis=1)
+        np.bitwise_or.at(self.array, index.ravel(), mask.ravel())
+        self.count += len(keys)
+
+        return seen
+
+    def error_rate(self):
+        """ estimated false positive rate at the current fill """
+        return (1 - math.exp(-float(self.hashes) * self.count / self.size)) ** self.hashes
+
+def bloom_size(memory, expected):
+    """ returns the bits and hashes of the best bloom filter for expected keys in memory bytes """
+    bits = max(64, int(memory) * 8)
+    hashes = int(round(float(bits) / max(1, expected) * math.log(2)))
+    return bits, min(16, max(1, hashes))
+
+def line_keys(lines):
+    """ returns the 128 bit keys of utf8 lines as an (n, 2) uint64 array """
+    digests = b''.join(hashlib.md5(line).digest() for line in lines)
+    return np.frombuffer(digests, dtype=np.uint64).reshape(-1, 2)
+
+class MinHasher:
+    """
+    MinHash of word shingles, with the signature cut into lsh band keys
+    Made from its settings only, so it can be rebuilt in worker processes
+    """
+    def __init__(self, bands=BANDS, rows=ROWS, shingle=SHINGLE, seed=1):
+        self.bands = bands
+        self.rows = rows
+        self.shingle = shingle
+
+        random = np.random.RandomState(seed)
+        self.a = random.randint(1, 1 << 32, size=bands * rows).astype(np.uint64)
+        self.b = random.randint(0, 1 << 32, size=bands * rows).astype(np.uint64)
+
+    def signature(self, text):
+        """ returns the minhash signature of a unicode text, None for empty text """
+        words = text.split()
+        if not words:
+            return None
+
+        count = max(1, len(words) - self.shingle + 1)
+        shingles = set(u' '.join(words[i:i + self.shingle]).encode('utf8') for i in xrange(count))
+        values = np.array([zlib.crc32(shingle) & 0xffffffff for shingle in shingles], dtype=np.uint64)
+
+        signature = np.empty(self.bands * self.rows, dtype=np.uint64)
+        signature.fill(MERSENNE_61)
+        for start in xrange(0, len(values), SHINGLE_BUFFER):
+            chunk = values[start:start + SHINGLE_BUFFER, None]
+            np.minimum(signature, ((chunk * self.a + self.b) % MERSENNE_61).min(axis=0), signature)
+
+        return signature
+
+    def band_keys(self, text):
+        """ returns the lsh band keys of a unicode text as a (bands, 2) uint64 array """
+        signature = self.signature(text)
+        if signature is None:
+            return np.zeros((0, 2), dtype=np.uint64)
+
+        bands = signature.reshape(self.bands, self.rows)
+        return line_keys(str(band) + bands[band].tobytes() for band in range(self.bands))
+
+class Deduplicator:
+    """
+    Drops near duplicate articles and exact duplicate lines within memory bytes
+    Articles are compared by lsh band keys (see MinHasher), lines by md5,
+    each kept in a bloom filter, so a small share of unique lines and articles
+    is dropped too; report() estimates how many
+    Given the name of a file from save() it carries on from there, its settings
+    taking the place of the others
+    """
+    def __init__(self, memory=MEMORY, expected_lines=EXPECTED_LINES, expected_articles=EXPECTED_ARTICLES,
+                 bands=BANDS, rows=ROWS, shingle=SHINGLE, state=None):
+        self.settings = {"memory": memory, "expected_lines": expected_lines, "expected_articles": expected_articles,
+                         "bands": bands, "rows": rows, "shingle": shingle}
+        self.counts = {"articles": 0, "near_duplicate_articles": 0, "lines": 0, "duplicate_lines": 0,
+                       "bytes": 0, "removed_bytes": 0}
+        arrays = {"lines": None, "articles": None}
+        filled = {"lines": 0, "articles": 0}
+
+        if state:
+            data = np.load(state)
+            saved = json.loads(str(data["state"]))
+            self.settings = dict((str(key), value) for key, value in saved["settings"].iteritems())
+            self.counts = saved["counts"]
+            arrays = {"lines": data["lines"], "articles": data["articles"]}
+            filled = saved["filled"]
+
+        memory = self.settings["memory"]
+        bits, hashes = bloom_size(memory * LINE_SHARE, self.settings["expected_lines"])
+        self.lines = BloomFilter(bits, hashes, arrays["lines"], filled["lines"])
+
+        bits, hashes = bloom_size(memory * (1 - LINE_SHARE), self.settings["expected_articles"] * self.settings["bands"])
+        self.articles = BloomFilter(bits, hashes, arrays["articles"], filled["articles"])
+
+    def hasher(self):
+        """ the MinHasher giving this deduplicator's band keys """
+        return MinHasher(self.settings["bands"], self.settings["rows"], self.settings["shingle"])
+
+    def filter(self, text, band_keys):
+        """ returns the utf8 lines of an article left after dropping duplicates """
+        counts = self.counts
+        if not text:
+            return text
+
+        counts["articles"] += 1
+        counts["bytes"] += len(text)
+
+        if self.articles.check_add(band_keys).any():
+            counts["near_duplicate_articles"] += 1
+            counts["removed_bytes"] += len(text)
+            return b''
+
+        lines = text.splitlines(True)
+        unique = list(set(lines))
+        seen = dict(zip(unique, self.lines.check_add(line_keys(unique)).tolist()))
+
+        kept = []
+        for line in lines:
+            if seen[line]:
+                counts["duplicate_lines"] += 1
+                counts["removed_bytes"] += len(line)
+            else:
+                kept.append(line)
+                # later copies within the article are duplicates too
+                seen[line] = True
+
+        counts["lines"] += len(lines)
+
+        return b''.join(kept)
+
+    def report(self):
+        """ returns the counts of what was removed, with the estimated filter error rates """
+        report = dict(self.counts)
+        report["line_error_rate"] = self.lines.error_rate()
+        report["article_error_rate"] = 1 - (1 - self.articles.error_rate()) ** self.settings["bands"]
+        report["memory"] = self.lines.array.nbytes + self.articles.array.nbytes
+        return report
+
+    def save(self, path):
+        """ saves the filters and counts to an .npz file, returns its name """
+        state = {"settings": self.settings, "counts": self.counts,
+                 "filled": {"lines": self.lines.count, "articles": self.articles.count}}
+
+        with open(path, 'wb') as outfile:
+            np.savez(outfile, lines=self.lines.array, articles=self.articles.array, state=np.array(json.dumps(state)))
+        return path
+
+def save_report(deduplicator, path):
+    """ saves the report of a deduplicator as json, returns the file name """
+    with open(path, 'w') as outfile:
+        json.dump(deduplicator.report(), outfile, indent=2, sort_keys=True)
+    return path
@@ -5,24 +5,63 @@
 
 from __future__ import absolute_import
 from __future__ import print_function
-from xml.etree.cElementTree import iterparse
+from requests.packages.urllib3.exceptions import ProtocolError
+from xml.etree.cElementTree import iterparse, ParseError
+from xml.sax.saxutils import escape
 
 import arapy
 import arapy.normalization as norm
+import arapy.util as util
 import codecs
+import collections
 import csv
+import hashlib
+import json
 import numpy as np
 import os
+import Queue
+import random
 import re
 import requests
 import socket
+import sqlite3
 import StringIO
 import subprocess
 import time
+from multiprocessing.pool import ThreadPool
 
 MADAPORT = 8223
 #94223
 
+# java heap of each madamira server
+HEAP = "2500m"
+
+# errors of a request whose server may have died, before or while answering
+SERVER_ERRORS = (requests.exceptions.ConnectionError, requests.exceptions.ChunkedEncodingError,
+                 ProtocolError, ParseError)
+
+# requests a MadamiraClient keeps going at once
+IN_FLIGHT = 8
+
+# size limit of an AnalysisCache, in bytes of stored analyses
+CACHE_BYTES = 1 << 30
+
+# sentences analyzed in context to check a by type transform
+TYPE_SAMPLE = 1000
+
+# word features kept by analyze and the transforms
+TRANSFORM_FEATURES = ("lemma", "pos", "tokens")
+
+# bytes of sentences sent in the first request of a batched job, and the bounds
+# the batch size adapts between
+BATCH_BYTES = 1 << 14
+MIN_BATCH_BYTES = 1 << 10
+MAX_BATCH_BYTES = 1 << 20
+
+# seconds a batched request should take, long enough to spread the cost of the
+# request config and short enough to keep memory and retries small
+TARGET_SECONDS = 2.0
+
 class Madamira:
     url="http://localhost:" + str(MADAPORT)
     headers = {'Content-Type': 'application/xml'}
@@ -102,12 +141,18 @@ class Madamira:
 
         <in_doc id="in_doc">\n"""
     xml_seg_start = """<in_seg id="in_seg">\n"""
+    xml_seg_id_start = """<in_seg id="{0}">\n"""
     xml_seg_end = """\n</in_seg>\n"""
     xml_suffix = """</in_doc>
 
     </madamira_input>"""
     config_prefix="{urn:edu.columbia.ccls.madamira.configuration:0.1}"
 
+    def __init__(self, port=MADAPORT, heap=HEAP):
+        self.port = port
+        self.heap = heap
+        self.url = "http://localhost:" + str(port)
+
     def __enter__(self):
         self.start_server()
         return self
@@ -116,89 +161,375 @@ class Madamira:
         self.stop_server()
 
     def start_server(self):
-        cwd = os.getcwd()
-        os.chdir(os.path.dirname(arapy.__file__)+"/resources/MADAMIRA-release-20150421-2.1/")
-
-        self.pid = subprocess.Popen(['java', 
-                                     '-Xmx2500m', 
-                                     '-Xms2500m', 
-                                     '-XX:NewRatio=3', 
-                                     '-jar', 
-                                     'MADAMIRA-release-20150421-2.1.jar', 
-                                     '-s', 
-                                     '-msaonly'])
+        self.launch()
 
         print("Waiting for madamira to initialize.")
+        self.wait()
+
+    def launch(self):
+        """ starts the server process without waiting for it """
+        command = ['java', 
+                   '-Xmx'+self.heap, 
+                   '-Xms'+self.heap, 
+                   '-XX:NewRatio=3', 
+                   '-jar', 
+                   'MADAMIRA-release-20150421-2.1.jar', 
+                   '-s', 
+                   '-msaonly']
+
+        # the server listens on MADAPORT unless told otherwise
+        if self.port != MADAPORT:
+            command += ['-port', str(self.port)]
+
+        self.pid = subprocess.Popen(command, cwd=os.path.dirname(arapy.__file__)+"/resources/MADAMIRA-release-20150421-2.1/")
+
+    def wait(self):
+        """ waits for the server to accept connections """
         time.sleep(10)
 
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        result = sock.connect_ex(('localhost',MADAPORT))
+        result = sock.connect_ex(('localhost',self.port))
         while(result != 0):
             sock.close()
+            if not self.alive():
+                raise RuntimeError("MADAMIRA exited on port "+str(self.port))
             time.sleep(1)
 
             sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            result = sock.connect_ex(('localhost',MADAPORT))
-
-        os.chdir(cwd)
+            result = sock.connect_ex(('localhost',self.port))
+        sock.close()
 
         self.session = requests.Session()
 
+    def alive(self):
+        """ checks that the server process is still running """
+        return self.pid.poll() is None
+
+    def restart(self):
+        """ kills the server and starts a new one on the same port """
+        self.stop_server()
+        self.start_server()
+
     def stop_server(self):
         self.session.close()
-        self.pid.kill()
+
+        # a server that died and was already reaped (see alive) can't be killed
+        if self.pid.poll() is None:
+            self.pid.kill()
+        self.pid.wait()
         print("Shut down MADAMIRA.")
 
-    def process(self, text):
-        """ Returns madamira xml output for a string input """
+    @staticmethod
+    def query(sentences, ids=None, prefix=None):
+        """
+        Returns the madamira xml input for a list of sentences, optionally with segment ids
+        prefix is the request config, the full xml_prefix by default (see request_prefix)
+        """
 
         query = StringIO.StringIO()
-        query.write(Madamira.xml_prefix)
+        query.write(Madamira.xml_prefix if prefix is None else prefix)
 
-        for sentence in text:
-            query.write(Madamira.xml_seg_start)
+        for index, sentence in enumerate(sentences):
+            if ids is None:
+                query.write(Madamira.xml_seg_start)
+            else:
+                query.write(Madamira.xml_seg_id_start.format(ids[index]))
             query.write(sentence)
             query.write(Madamira.xml_seg_end)
 
         query.write(Madamira.xml_suffix)
-        query.seek(0)
 
-        response = self.session.post(Madamira.url, headers=Madamira.headers, data=query.read())
+        return query.getvalue()
+
+    def post(self, query):
+        """
+        Sends madamira xml input to the server, returns its MadamiraOutput
+        The response is read in full first, so the output can be parsed any number
+        of times and the connection is free for the next request
+        """
 
-        response.encoding = "utf8"
+        response = self.session.post(self.url, headers=Madamira.headers, data=query)
+        response.raise_for_status()
 
-        return MadamiraOutput(response.text)
+        # the xml declares its own encoding, the parser reads the raw bytes
+        return MadamiraOutput(response.content)
+
+    def stream(self, query):
+        """
+        Sends madamira xml input to the server, yields each MadamiraSentence of its
+        output as it arrives (see MadamiraOutput.sentences)
+        The response is closed once the output is read through or the generator dropped
+        """
+
+        response = self.session.post(self.url, headers=Madamira.headers, data=query, stream=True)
+        try:
+            response.raise_for_status()
+            response.raw.decode_content = True
+
+            for sent in MadamiraOutput(response.raw).sentences():
+                yield sent
+        finally:
+            response.close()
+
+    def process(self, text):
+        """ Returns madamira xml output for a string input """
+
+        return self.post(Madamira.query(text))
+
+    def analyze(self, sentences, features=TRANSFORM_FEATURES):
+        """
+        Returns the word record lists of a batch of unicode sentences, in one request
+        that only asks for features (see MadamiraSentence.records and request_prefix)
+        Sentences are escaped and sent with their position as segment id, so the
+        output lines up with them; blank sentences are not sent and get no words
+        """
+        segments = [(index, sentence) for index, sentence in enumerate(sentences) if sentence.strip()]
+        analyses = [[] for sentence in sentences]
+
+        if not segments:
+            return analyses
+
+        query = Madamira.query([escape(sentence).encode('utf8') for index, sentence in segments],
+                               [index for index, sentence in segments], request_prefix(features))
+
+        for sent in self.stream(query):
+            analyses[int(sent.id())] = sent.records(features)
+
+        return analyses
+
+    def analyze_batches(self, batches, sizer=None, features=TRANSFORM_FEATURES):
+        """ Yields (batch, analyses) for each batch of sentences, see analyze """
+        for batch in batches:
+            start = time.time()
+            analyses = self.analyze(batch, features)
+
+            if sizer:
+                sizer.update(sentence_bytes(batch), time.time() - start)
+
+            yield batch, analyses
 
     def process_sentence(self, text):
         """ Returns madamira xml output for a word string input """
 
-        query = StringIO.StringIO()
-        query.write(Madamira.xml_prefix)
-    
-        query.write(Madamira.xml_seg_start)
-        query.write(text)
-        query.write(Madamira.xml_seg_end)
+        output = self.post(Madamira.query([text]))
+
+        return [word for doc in output.docs() for sent in doc.sentences() for word in sent.words()]
+
+# madamira request variables, in config order, with the word features that need them
+REQUEST_VARIABLES = [("STEM", "stem"), ("GLOSS", "gloss"), ("LEMMA", "lemma"), ("DIAC", "diac"),
+                     ("ASP", "asp"), ("CAS", "cas"), ("ENC0", "enc0"), ("ENC1", "enc1"), ("ENC2", "enc2"),
+                     ("GEN", "gen"), ("MOD", "mod"), ("NUM", "num"), ("PER", "per"), ("POS", "pos"),
+                     ("PRC0", "prc0"), ("PRC1", "prc1"), ("PRC2", "prc2"), ("PRC3", "prc3"),
+                     ("STT", "stt"), ("VOX", "vox"), ("BW", "bw"), ("SOURCE", "source")]
+
+config_start = """<?xml version="1.0" encoding="UTF-8"?>
+<madamira_input xmlns="urn:edu.columbia.ccls.madamira.configuration:0.1">
+    <madamira_configuration>
+        <preprocessing sentence_ids="false" separate_punct="true" input_encoding="UTF8"/>
+        <overall_vars output_encoding="UTF8" dialect="MSA" output_analyses="TOP" morph_backoff="NONE"/>
+        <requested_output>
+            <req_variable name="PREPROCESSED" value="true" />
+"""
+config_variable = """            <req_variable name="{0}" value="{1}" />\n"""
+config_tokenization = """        </requested_output>
+        <tokenization>
+"""
+config_myd3 = """            <scheme alias="MyD3">
+                <!-- Same as D3 -->
+                <scheme_override alias="MyD3"
+                                 form_delimiter="\u00B7"
+                                 include_non_arabic="true"
+                                 mark_no_analysis="false"
+                                 token_delimiter=" "
+                                 tokenize_from_BW="false">
+                    <split_term_spec term="PRC3"/>
+                    <split_term_spec term="PRC2"/>
+                    <split_term_spec term="PART"/>
+                    <split_term_spec term="PRC0"/>
+                    <split_term_spec term="REST"/>
+                    <split_term_spec term="ENC0"/>
+                    <token_form_spec enclitic_mark="+"
+                                     proclitic_mark="+"
+                                     token_form_base="WORD"
+                                     transliteration="UTF8">
+                        <normalization type="ALEF"/>
+                        <normalization type="YAA"/>
+                        <normalization type="DIAC"/>
+                        <normalization type="LEFTPAREN"/>
+                        <normalization type="RIGHTPAREN"/>
+                    </token_form_spec>
+                </scheme_override>
+            </scheme>
+"""
+config_end = """        </tokenization>
+    </madamira_configuration>
+
+    <in_doc id="in_doc">\n"""
+
+request_prefixes = {}
+
+def request_prefix(features=None):
+    """
+    Returns the request config asking madamira for just the word features given
+    (see extract_word), the MyD3 tokenization only for 'tokens'
+    Prefixes are built once per feature set; None gives the full Madamira.xml_prefix
+    """
+    if features is None:
+        return Madamira.xml_prefix
+
+    features = frozenset(features)
+    if features not in request_prefixes:
+        prefix = StringIO.StringIO()
+        prefix.write(config_start)
+
+        for name, feature in REQUEST_VARIABLES:
+            prefix.write(config_variable.format(name, "true" if feature in features else "false"))
+
+        prefix.write(config_tokenization)
+        if "tokens" in features:
+            prefix.write(config_myd3)
+        prefix.write(config_end)
+
+        request_prefixes[features] = prefix.getvalue()
+
+    return request_prefixes[features]
+
+class MadamiraPool:
+    """
+    Several madamira servers, on ports port, port + 1, ... each with heap memory
+    Batches are analyzed concurrently, one per idle server, and come back in order
+    A server whose process died is restarted and its batch sent again
+    """
+    def __init__(self, workers=2, port=MADAPORT, heap=HEAP):
+        self.servers = [Madamira(port + i, heap) for i in range(workers)]
 
-        query.write(Madamira.xml_suffix)
-        query.seek(0)
+    def __enter__(self):
+        self.start_server()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop_server()
+
+    def start_server(self):
+        # the servers load in parallel
+        for server in self.servers:
+            server.launch()
+
+        print("Waiting for madamira to initialize.")
+        for server in self.servers:
+            server.wait()
+
+        self.idle = Queue.Queue()
+        for server in self.servers:
+            self.idle.put(server)
+
+        self.pool = ThreadPool(len(self.servers))
 
-        response = requests.post(Madamira.url, headers=Madamira.headers, data=query.read())
+    def stop_server(self):
+        self.pool.close()
+        self.pool.join()
+
+        for server in self.servers:
+            server.stop_server()
+
+    def analyze(self, sentences, features=TRANSFORM_FEATURES):
+        """ analyze() on the next idle server """
+        server = self.idle.get()
+        try:
+            try:
+                return server.analyze(sentences, features)
+            except SERVER_ERRORS:
+                if server.alive():
+                    raise
+
+                server.restart()
+                return server.analyze(sentences, features)
+        finally:
+            self.idle.put(server)
+
+    def _timed_analyze(self, args):
+        batch, features = args
+        start = time.time()
+        analyses = self.analyze(batch, features)
+        return batch, analyses, time.time() - start
+
+    def analyze_batches(self, batches, sizer=None, features=TRANSFORM_FEATURES):
+        """ Yields (batch, analyses) for each batch of sentences, keeping every server busy """
+        tasks = ((batch, features) for batch in batches)
+        for batch, analyses, seconds in util.ordered_map(self.pool, self._timed_analyze, tasks, len(self.servers) * 2):
+            if sizer:
+                sizer.update(sentence_bytes(batch), seconds)
+
+            yield batch, analyses
+
+class MadamiraClient:
+    """
+    Thread safe client of a running madamira server, for services with many
+    concurrent requests
+    Keeps up to in_flight requests going over as many keep-alive connections
+    """
+    def __init__(self, port=MADAPORT, in_flight=IN_FLIGHT):
+        self.server = Madamira(port)
+        self.server.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=in_flight)
+        self.server.session.mount("http://", adapter)
+
+        self.in_flight = in_flight
+        self.pool = ThreadPool(in_flight)
 
-        response.encoding = "utf8"
+    def __enter__(self):
+        return self
 
-        return [word for doc in MadamiraOutput(response.text).docs() for sent in doc.sentences() for word in sent.words()]
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        self.server.session.close()
+
+    def process(self, text):
+        """ Returns madamira xml output for a string input, blocking """
+        return self.server.process(text)
+
+    def submit(self, text):
+        """
+        Starts processing a string input, returns an AsyncResult of its MadamiraOutput
+        The response is read by the worker, see Madamira.post
+        """
+        return self.pool.apply_async(self.server.process, (text,))
+
+    def process_all(self, texts):
+        """
+        Yields the MadamiraOutput of each string input, in order
+        texts is read only as outputs are taken, at most in_flight ahead
+        """
+        return util.ordered_map(self.pool, self.server.process, texts, self.in_flight)
 
 class MadamiraOutput:
-    def __init__(self, xmltext):
-        self.xml = xmltext.encode("utf8")
+    """
+    Madamira xml output, parsed as it is read
+    xml is the output text, which can be parsed any number of times, or a file
+    like object such as a streamed response, which can only be read through once
+    """
+    def __init__(self, xml):
+        if isinstance(xml, unicode):
+            xml = xml.encode("utf8")
+
+        self.xml = xml
+
+    def source(self):
+        """ returns a file like object to parse the xml from """
+        if isinstance(self.xml, str):
+            return StringIO.StringIO(self.xml)
+        return self.xml
 
     def docs(self):
         # madamira config prefix
         mp=Madamira.config_prefix
 
-        # get an iterable TODO use raw string?
-        # wrapper = codecs.StreamReader(StringIO.StringIO(self.xml), "utf8")
-        context = iterparse(StringIO.StringIO(self.xml), events=("start", "end"))
+        # get an iterable
+        context = iterparse(self.source(), events=("start", "end"))
 
         # turn it into an iterator
         context = iter(context)
@@ -216,6 +547,36 @@ class MadamiraOutput:
                 # don't keep the doc in memory
                 root.clear()#find(mp+'madamira_output').clear()
 
+    def sentences(self):
+        """
+        Yields each MadamiraSentence of the output as soon as it is parsed
+        a sentence is cleared once the next one is read, only one is kept in memory
+        """
+        mp=Madamira.config_prefix
+
+        context = iter(iterparse(self.source(), events=("start", "end")))
+        event, root = context.next()
+
+        doc = root
+        for event, elem in context:
+
+            if event == 'start' and elem.tag == mp+'out_doc':
+                doc = elem
+
+            elif event == 'end' and elem.tag == mp+'out_seg':
+
+                yield MadamiraSentence(elem)
+
+                # segments are children of their doc, which the parser keeps adding to
+                doc.clear()
+
+            elif event == 'end' and elem.tag == mp+'out_doc':
+                root.clear()
+
+    def columns(self, features=TRANSFORM_FEATURES):
+        """ Returns the WordColumns of all the sentences of the output """
+        return WordColumns((sentence.records(features) for sentence in self.sentences()), features)
+
 class MadamiraDoc:
     def __init__(self, elem):
         self.elem = elem
@@ -231,6 +592,9 @@ class MadamiraSentence:
     def __init__(self, sentence):
         self.sentence = sentence
 
+    def id(self):
+        return self.sentence.get('id')
+
     def words(self):
         mp = Madamira.config_prefix
 
@@ -238,6 +602,13 @@ class MadamiraSentence:
 
             yield MadamiraWord(word)
 
+    def records(self, features=TRANSFORM_FEATURES):
+        """ Returns a record of the features of each word, see extract_word """
+        mp = Madamira.config_prefix
+        record = record_type(features)
+
+        return [extract_word(word, features, record) for word in self.sentence.find(mp+'word_info').iter(mp+'word')]
+
     def chunks(self):
         mp = Madamira.config_prefix
 
@@ -256,17 +627,7 @@ class MadamiraWord:
         # grab the lemma data
         lemma = self.word.find(mp+'svm_prediction').find(mp+'morph_feature_set').get('lemma')
 
-        # strip down to the arabic script
-        if not lemma:
-            return ""
-        elif len(lemma) == 0:
-            return ""
-        else:
-            norm_lemma = norm.normalize_charset(lemma).strip()
-            if len(norm_lemma) == 0:
-                return lemma
-            else:
-                return norm_lemma
+        return clean_lemma(lemma)
 
     def pos(self):
         mp = Madamira.config_prefix
@@ -283,6 +644,90 @@ class MadamiraWord:
 
         return tokens
 
+    def record(self, features=TRANSFORM_FEATURES):
+        """ Returns a record of the features of the word, see extract_word """
+        return extract_word(self.word, features)
+
+def clean_lemma(lemma):
+    """ strips a madamira lemma down to its arabic script, if it has any """
+    if not lemma:
+        return ""
+    else:
+        norm_lemma = norm.normalize_charset(lemma).strip()
+        if len(norm_lemma) == 0:
+            return lemma
+        else:
+            return norm_lemma
+
+# paths to the parts of a word element read by extract_word
+MORPH_PATH = Madamira.config_prefix+'svm_prediction/'+Madamira.config_prefix+'morph_feature_set'
+TOKENS_PATH = Madamira.config_prefix+"tokenized[@scheme='MyD3']"
+TOK_TAG = Madamira.config_prefix+'tok'
+
+record_types = {}
+
+def record_type(features):
+    """ Returns the namedtuple class of word records with these features, one per feature tuple """
+    features = tuple(features)
+    if features not in record_types:
+        record_types[features] = collections.namedtuple("WordRecord", features)
+    return record_types[features]
+
+def extract_word(word, features=TRANSFORM_FEATURES, record=None):
+    """
+    Reads the features of a madamira <word> element into a namedtuple record, once
+    'word' is the input word, 'lemma' the lemma as MadamiraWord.lemma() gives it,
+    'tokens' the list of MyD3 tokens, and other features are read from the
+    morph feature set ('pos', 'stem', 'diac', 'gloss', 'asp', ...), None when missing
+    """
+    if record is None:
+        record = record_type(features)
+
+    morph = word.find(MORPH_PATH)
+    if morph is None:
+        morph = {}
+
+    values = []
+    for feature in features:
+        if feature == "lemma":
+            values.append(clean_lemma(morph.get('lemma')))
+        elif feature == "tokens":
+            tokenized = word.find(TOKENS_PATH)
+            values.append([] if tokenized is None else [token.get('form0') for token in tokenized.iter(TOK_TAG)])
+        elif feature == "word":
+            values.append(word.get('word'))
+        else:
+            values.append(morph.get(feature))
+
+    return record(*values)
+
+class WordColumns:
+    """
+    Word records of many sentences as one list per feature, for whole documents
+    offsets holds where each sentence starts in the lists, plus the end of the last
+    """
+    def __init__(self, sentences, features=TRANSFORM_FEATURES):
+        self.features = tuple(features)
+        self.offsets = [0]
+        self.columns = dict((feature, []) for feature in self.features)
+
+        for records in sentences:
+            for index, feature in enumerate(self.features):
+                self.columns[feature].extend(record[index] for record in records)
+            self.offsets.append(self.offsets[-1] + len(records))
+
+    def __len__(self):
+        """ number of sentences """
+        return len(self.offsets) - 1
+
+    def __getitem__(self, feature):
+        """ the list of a feature for every word """
+        return self.columns[feature]
+
+    def sentence(self, index, feature):
+        """ the values of a feature for the words of one sentence """
+        return self.columns[feature][self.offsets[index]:self.offsets[index + 1]]
+
 
 class MadamiraChunk:
     def __init__(self, chunk):
@@ -314,101 +759,394 @@ class MadamiraChunk:
 
 
 
+class BatchSizer:
+    """
+    Picks the bytes of sentences to send per request from the server's recent
+    throughput, growing batches while requests take under target_seconds and
+    shrinking them when they take longer, within min_bytes and max_bytes
+    """
+    def __init__(self, start=BATCH_BYTES, target_seconds=TARGET_SECONDS, min_bytes=MIN_BATCH_BYTES, max_bytes=MAX_BATCH_BYTES):
+        self.bytes = start
+        self.target_seconds = target_seconds
+        self.min_bytes = min_bytes
+        self.max_bytes = max_bytes
+
+    def update(self, size, seconds):
+        """ records that a request of size bytes took seconds """
+        if not size:
+            return
+
+        # the size that would have taken target_seconds, moving at most 2x per request
+        best = size * self.target_seconds / max(seconds, 1e-3)
+        best = min(max(best, self.bytes / 2.0), self.bytes * 2.0)
+
+        self.bytes = int(min(max(best, self.min_bytes), self.max_bytes))
+
+def sentence_bytes(batch):
+    """ utf8 size of a batch of sentences """
+    return sum(len(sentence.encode('utf8')) for sentence in batch)
+
+def sentence_batches(lines, sizer):
+    """
+    Yields lists of unicode sentences from utf8 lines, each about sizer.bytes long
+    the size is read as each batch starts, so it follows sizer updates
+    """
+    batch = []
+    size = 0
+
+    for line in lines:
+        batch.append(line.decode('utf8').rstrip(u'\r\n'))
+        size += len(line)
+
+        if size >= sizer.bytes:
+            yield batch
+            batch = []
+            size = 0
+
+    if batch:
+        yield batch
+
+class AnalysisCache:
+    """
+    Persistent sqlite cache of sentence analyses, local to one file
+    Entries are keyed by the sha1 of the request config and of the sentence with
+    its whitespace normalized (madamira splits words on whitespace, so that does not
+    change the analysis), and hold the word records of the cache's features
+    Past max_bytes the least recently used entries are evicted
+    """
+    def __init__(self, path="madamira.cache", max_bytes=CACHE_BYTES, features=TRANSFORM_FEATURES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.features = tuple(features)
+        self.config = hashlib.sha1(request_prefix(self.features) + repr(self.features)).digest()
+
+        self.db = sqlite3.connect(path)
+        self.db.execute("CREATE TABLE IF NOT EXISTS analyses "
+                        "(key BLOB PRIMARY KEY, value BLOB, size INTEGER, used INTEGER)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS analyses_used ON analyses (used)")
+        self.db.commit()
+
+        self.size, self.clock = self.db.execute("SELECT COALESCE(SUM(size), 0), COALESCE(MAX(used), 0) FROM analyses").fetchone()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def close(self):
+        self.db.commit()
+        self.db.close()
+
+    def key(self, sentence):
+        """ cache key of a unicode sentence """
+        return hashlib.sha1(self.config + u' '.join(sentence.split()).encode('utf8')).digest()
+
+    def get_many(self, keys):
+        """ returns a dict of the cached keys to their lists of word records """
+        record = record_type(self.features)
+        found = {}
+        keys = list(set(keys))
+
+        # sqlite limits the parameters of a statement
+        for start in range(0, len(keys), 500):
+            chunk = [sqlite3.Binary(key) for key in keys[start:start + 500]]
+            rows = self.db.execute("SELECT key, value FROM analyses WHERE key IN (" + ",".join("?" * len(chunk)) + ")", chunk)
+            for key, value in rows:
+                found[bytes(key)] = [record(*values) for values in json.loads(bytes(value).decode('utf8'))]
+
+        self.clock += 1
+        self.db.executemany("UPDATE analyses SET used = ? WHERE key = ?",
+                            [(self.clock, sqlite3.Binary(key)) for key in found])
+
+        self.hits += len(found)
+        self.misses += len(keys) - len(found)
+
+        return found
+
+    def put_many(self, analyses):
+        """ caches a dict of keys to lists of word records """
+        self.clock += 1
+        rows = []
+        for key, words in analyses.iteritems():
+            value = json.dumps(words, ensure_ascii=False).encode('utf8')
+            rows.append((sqlite3.Binary(key), sqlite3.Binary(value), len(value), self.clock))
+
+        for row in rows:
+            old = self.db.execute("SELECT size FROM analyses WHERE key = ?", row[:1]).fetchone()
+            self.size += row[2] - (old[0] if old else 0)
+        self.db.executemany("INSERT OR REPLACE INTO analyses VALUES (?, ?, ?, ?)", rows)
+
+        if self.size > self.max_bytes:
+            self.evict()
+
+        self.db.commit()
+
+    def evict(self):
+        """ drops the least recently used entries until the cache is a tenth under max_bytes """
+        target = self.max_bytes * 0.9
+        rows = self.db.execute("SELECT key, size FROM analyses ORDER BY used")
+
+        dropped = []
+        for key, size in rows:
+            if self.size <= target:
+                break
+            dropped.append((key,))
+            self.size -= size
+
+        self.db.executemany("DELETE FROM analyses WHERE key = ?", dropped)
+        self.evictions += len(dropped)
+
+    def stats(self):
+        """ returns the hits, misses, evictions, entries and bytes of the cache """
+        entries = self.db.execute("SELECT COUNT(*) FROM analyses").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "evictions": self.evictions,
+                "entries": entries, "bytes": self.size}
+
+def cached_batches(m, batches, cache, sizer=None):
+    """
+    Yields (batch, analyses) like m.analyze_batches, taking what it can from cache
+    Only the sentences missing from the cache are sent, and their analyses cached
+    """
+    pending = collections.deque()
+
+    def misses():
+        for batch in batches:
+            keys = [cache.key(sentence) for sentence in batch]
+            found = cache.get_many([key for key, sentence in zip(keys, batch) if sentence.strip()])
+
+            missing = {}
+            for key, sentence in zip(keys, batch):
+                if key not in found and sentence.strip():
+                    missing[key] = sentence
+
+            pending.append((batch, keys, found, missing.keys()))
+            yield missing.values()
+
+    for sent, analyses in m.analyze_batches(misses(), sizer, cache.features):
+        batch, keys, found, missing = pending.popleft()
+
+        fresh = dict(zip(missing, analyses))
+        cache.put_many(fresh)
+        found.update(fresh)
+
+        yield batch, [found.get(key, []) for key in keys]
+
+def word_values(words, feature):
+    """ returns the values of a feature ('lemma', 'pos' or 'tokens') for a list of word records """
+    if feature == "tokens":
+        return [token for word in words for token in word.tokens]
+    else:
+        return [getattr(word, feature) for word in words]
+
+def word_features(words, feature):
+    """ returns one output line of a feature for the words of a sentence """
+    return u' '.join(word_values(words, feature)).rstrip()
+
+def count_types(sentence_file, sample=TYPE_SAMPLE, seed=0):
+    """
+    Counts the whitespace separated forms of a file of utf8 sentences
+    returns the Counter of forms and a random sample of its non blank sentences
+    """
+    counts = collections.Counter()
+    rand = random.Random(seed)
+    sampled = []
+    seen = 0
+
+    with open(sentence_file, 'rb') as sentences:
+        for line in sentences:
+            forms = line.decode('utf8').split()
+            if not forms:
+                continue
+
+            counts.update(forms)
+
+            # reservoir sampling
+            seen += 1
+            if len(sampled) < sample:
+                sampled.append(line)
+            else:
+                index = rand.randint(0, seen - 1)
+                if index < sample:
+                    sampled[index] = line
+
+    return counts, sampled
+
+def type_key(form):
+    """
+    returns the key a form is grouped under for type level analysis, its normalization
+    with non arabic chars kept, or the form itself when that leaves nothing
+    """
+    key = norm.normalize(form, ar_only=False)
+    return key if key.strip() else form
+
+def type_dictionary(m, counts, features, sizer=None, cache=None):
+    """
+    Analyzes each form of a Counter once, out of context, in batches of forms
+    Forms are grouped by type_key, each group taking the analysis
+    its forms give most often in the corpus, weighted by their counts
+    returns a dict of type key to a tuple of value lists per feature,
+    and the dict of form to type key
+    """
+    forms = list(counts)
+    normal = dict((form, type_key(form)) for form in forms)
+    votes = collections.defaultdict(collections.Counter)
+
+    batches = sentence_batches((form.encode('utf8') + b'\n' for form in forms), sizer or BatchSizer(MAX_BATCH_BYTES))
+    if cache:
+        results = cached_batches(m, batches, cache, sizer)
+    else:
+        results = m.analyze_batches(batches, sizer, features)
+
+    for batch, analyses in results:
+        for form, words in zip(batch, analyses):
+            analysis = tuple(tuple(word_values(words, feature)) for feature in features)
+            votes[normal[form]][analysis] += counts[form]
+
+    # ties go to the smallest analysis, so the choice does not depend on dict order
+    dictionary = dict((key, min(options, key=lambda analysis: (-options[analysis], analysis)))
+                      for key, options in votes.iteritems())
+
+    return dictionary, normal
+
+def type_analysis(sentence, dictionary, normal, features):
+    """ returns the value lists per feature of a unicode sentence, from a type_dictionary """
+    values = [[] for feature in features]
+
+    for form in sentence.split():
+        key = normal.get(form)
+        if key is None:
+            key = normal[form] = type_key(form)
+
+        analysis = dictionary.get(key)
+        if analysis:
+            for index, form_values in enumerate(analysis):
+                values[index].extend(form_values)
+
+    return values
+
+def type_disagreement(m, sentences, dictionary, normal, features, cache=None):
+    """
+    Compares the type level analysis of utf8 sentences with their analysis in context
+    Values are compared in order when both give as many for a sentence, other
+    sentences are counted as misaligned
+    returns the counts and rates of values that disagree per feature
+    """
+    batches = sentence_batches(sentences, BatchSizer())
+    if cache:
+        results = cached_batches(m, batches, cache)
+    else:
+        results = m.analyze_batches(batches, features=features)
+
+    misaligned = 0
+    compared = dict((feature, 0) for feature in features)
+    disagreements = dict((feature, 0) for feature in features)
+
+    for batch, analyses in results:
+        for sentence, words in zip(batch, analyses):
+            by_type = type_analysis(sentence, dictionary, normal, features)
+            in_context = [word_values(words, feature) for feature in features]
+
+            if [len(values) for values in by_type] != [len(values) for values in in_context]:
+                misaligned += 1
+                continue
+
+            for index, feature in enumerate(features):
+                compared[feature] += len(in_context[index])
+                disagreements[feature] += sum(1 for a, b in zip(by_type[index], in_context[index]) if a != b)
+
+    return {"sample_sentences": len(sentences), "misaligned_sentences": misaligned,
+            "compared": compared, "disagreements": disagreements,
+            "disagreement_rates": dict((feature, float(disagreements[feature]) / compared[feature] if compared[feature] else 0.0)
+                                       for feature in features)}
+
+def transform_types(m, sentence_file, outfiles, features, sizer=None, cache=None, sample=TYPE_SAMPLE):
+    """
+    Writes each feature of a sentence file to its outfile through a type_dictionary
+    returns a report of the token and type counts, and of how the dictionary
+    disagrees with analysis in context on a sample of sentences
+    """
+    counts, sampled = count_types(sentence_file, sample)
+    dictionary, normal = type_dictionary(m, counts, features, sizer, cache)
+
+    with open(sentence_file, 'rb') as sentences:
+        for line in sentences:
+            values = type_analysis(line.decode('utf8'), dictionary, normal, features)
+
+            for index, feature in enumerate(features):
+                outfiles[feature].write((u' '.join(values[index]).rstrip() + u'\n').encode('utf8'))
+
+    report = {"tokens": sum(counts.itervalues()), "types": len(counts), "normalized_types": len(dictionary)}
+    report.update(type_disagreement(m, sampled, dictionary, normal, features, cache))
+
+    return report
+
 def transform_sentence_file(sentence_file, 
                             lemmaout="lemmas.txt",
                             tokenout="token.txt",
                             posout="pos.txt",
                             lemmas=True,
                             pos=False, 
-                            tokens=False):
-    """returns filenames of lemmas and pos files"""
-    with Madamira() as m:
-
-        # open output files
-        lemma_out = None
-        lemma_buff = None
-        if lemmas:
-            lemma_buff = StringIO.StringIO()
-            lemma_file = lemmaout
-            lemma_out = open(lemma_file, 'w')
-
-        pos_out = None
-        pos_buff = None
-        if pos:
-            pos_buff = StringIO.StringIO()
-            pos_file = posout
-            pos_out = open(pos_file, 'w')
-
-        token_out = None
-        token_buff = None
-        if tokens:
-            token_buff = StringIO.StringIO()
-            token_file = tokenout
-            token_out = open(token_file, 'w')
-
-        # read files into a list, or buffer the sentences one at a time, of sentences
-        # sentence_list = open(sentence_file).read().splitlines()
-        with open(sentence_file, 'r') as sentences:
-            for sentence in sentences:
-
-                out = m.process([sentence])
-
-                for doc in out.docs():
-                    for sent in doc.sentences():
-
-                        for word in sent.words():
-                            if lemmas:
-                                lemma_buff.write(word.lemma())
-                                lemma_buff.write(" ")
-                            if pos:                        
-                                pos_buff.write(word.pos())
-                                pos_buff.write(" ")
-                            if tokens:
-                                for token in word.tokens():
-                                    token_buff.write(token)
-                                    token_buff.write(" ")
-
-                        # for chunk in sent.chunks()
-                        #     if tokens:   
-                                # token_list = word.tokens()
-                                # for token in token_list:                    
-                                #     token_buff.write(token) # TODO
-                                #     token_buff.write(" ")
-
-                        if lemmas:
-
-                            lemma_buff.seek(0)
-                            lemma_out.write(lemma_buff.read().rstrip().encode('utf8'))
-                            lemma_out.write('\n')
-                            lemma_buff.close()
-                            lemma_buff = StringIO.StringIO()
-
-                        if pos:
-                            pos_buff.seek(0)
-                            pos_out.write(pos_buff.read().rstrip().encode('utf8'))
-                            pos_out.write('\n')
-                            pos_buff.close()
-                            pos_buff = StringIO.StringIO()
-
-                        if tokens:
-                            token_buff.seek(0)
-                            token_out.write(token_buff.read().rstrip().encode('utf8'))
-                            token_out.write('\n')
-                            token_buff.close()
-                            token_buff = StringIO.StringIO()
-                
-            if lemmas:
-                lemma_buff.close()
-                lemma_out.close()
-            if pos:
-                pos_buff.close()
-                pos_out.close()
-            if tokens:
-                token_buff.close()
-                token_out.close()
-
-
-    return [lemma_file, pos_file, token_file]
+                            tokens=False,
+                            batch_bytes=BATCH_BYTES,
+                            workers=1,
+                            heap=HEAP,
+                            cache=None,
+                            cache_bytes=CACHE_BYTES,
+                            by_type=False,
+                            type_report="type_report.json"):
+    """
+    returns filenames of lemmas, pos and tokens files
+    Sentences go to madamira in batches, starting at batch_bytes and adapted to
+    keep requests near TARGET_SECONDS (see BatchSizer); every input line gets an
+    output line, empty for empty lines
+    workers > 1 runs that many madamira servers (see MadamiraPool), heap is the
+    java heap of each
+    cache is the file of an AnalysisCache kept within cache_bytes, sentences found
+    there are not sent again
+    by_type analyzes each distinct form once instead of each sentence (see
+    transform_types), much faster but blind to context; how often that changes
+    the output on a sample of sentences is saved to type_report as json
+    """
+    features = tuple(feature for feature, wanted in (("lemma", lemmas), ("pos", pos), ("tokens", tokens)) if wanted)
+    paths = {"lemma": lemmaout, "pos": posout, "tokens": tokenout}
+
+    with (MadamiraPool(workers, heap=heap) if workers > 1 else Madamira(heap=heap)) as m:
+
+        outfiles = dict((feature, open(paths[feature], 'wb')) for feature in features)
+        analysis_cache = AnalysisCache(cache, cache_bytes, features) if cache else None
+        try:
+            sizer = BatchSizer(batch_bytes)
+
+            if by_type:
+                util.save_json(transform_types(m, sentence_file, outfiles, features, sizer, analysis_cache), type_report)
+
+            else:
+                with open(sentence_file, 'rb') as sentences:
+                    batches = sentence_batches(sentences, sizer)
+
+                    if analysis_cache:
+                        results = cached_batches(m, batches, analysis_cache, sizer)
+                    else:
+                        results = m.analyze_batches(batches, sizer, features)
+
+                    for batch, analyses in results:
+
+                        for feature in features:
+                            outfiles[feature].write(u''.join(word_features(words, feature) + u'\n'
+                                                             for words in analyses).encode('utf8'))
+        finally:
+            for outfile in outfiles.values():
+                outfile.close()
+
+            if analysis_cache:
+                print("MADAMIRA cache:", analysis_cache.stats())
+                analysis_cache.close()
+
+    return [lemmaout, posout, tokenout]
 
     
 
@@ -6,12 +6,215 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-import re
+import arapy.util as util
 import codecs
+import hashlib
+import itertools
+import json
+import multiprocessing
+import numpy as np
+import os
+import re
+import shutil
+import sys
 
 # regex for arabic chars
 inv_arabic_charset = re.compile(ur'[^\u0600-\u06ff\u0750-\u077f\u08a0-\u08ff\u0030-\u0039\n\.]+', re.UNICODE)
 
+# the same charset as a lookup table over code points, the last entry stands in
+# for every code point past the table
+arabic_charset_lut = np.zeros(0x901, dtype=bool)
+for first, last in ((0x0600, 0x06ff), (0x0750, 0x077f), (0x08a0, 0x08ff), (0x0030, 0x0039)):
+    arabic_charset_lut[first:last + 1] = True
+arabic_charset_lut[ord(u'\n')] = True
+arabic_charset_lut[ord(u'.')] = True
+
+# batches are packed as code units of the same width as unicode strings,
+# so offsets into the packed array match string lengths on narrow builds too
+if sys.maxunicode > 0xffff:
+    batch_codec, batch_dtype = 'utf-32-le', np.uint32
+else:
+    batch_codec, batch_dtype = 'utf-16-le', np.uint16
+
+# bytes read per block by the file normalization functions
+BLOCK_SIZE = 1 << 22
+
+# bytes per cached chunk for checkpointed file normalization
+CHUNK_SIZE = 1 << 26
+
+# names of the normalize flags, in Normalizer argument order
+FLAG_NAMES = ("ar_only", "digits", "alif", "hamza", "yaa", "tashkil")
+
+# character classes for normalization and tashkil removal
+DIGITS = u'0123456789٠١٢٣٤٥٦٧٨٩'
+ALIF_FORMS = u'إأٱآا'
+HAMZA_SEATS = u'ؤئ'
+ALIF_HAMZA_SEATS = u'إأ'
+ALIF_MAQSURA = u'ى'
+HARAKAT = u'َُِْ'
+TANWIN = u'ًٌٍ'
+SHADDAH = u'ّ'
+KASHIDA = u'ـ'
+
+def _table(chars, replacement):
+    """ builds a unicode.translate table mapping each char to replacement (None deletes) """
+    return dict((ord(char), replacement) for char in chars)
+
+digits_table = _table(DIGITS, u'#')
+alif_table = _table(ALIF_FORMS, u'ا')
+hamza_table = _table(HAMZA_SEATS, u'ء')
+alif_hamza_table = _table(HAMZA_SEATS + ALIF_HAMZA_SEATS, u'ء')
+yaa_table = _table(ALIF_MAQSURA, u'ي')
+harakat_table = _table(HARAKAT, None)
+tanwin_table = _table(TANWIN, None)
+shaddah_table = _table(SHADDAH, None)
+kashida_table = _table(KASHIDA, None)
+
+tashkil_table = {}
+for table in (harakat_table, tanwin_table, shaddah_table, kashida_table):
+    tashkil_table.update(table)
+
+def _pattern(chars):
+    """ compiles a regex matching any one of chars """
+    return re.compile(u'[' + chars + u']', re.UNICODE)
+
+# the same classes as regexes, on py2 re.sub beats unicode.translate for these
+digits_pattern = _pattern(DIGITS)
+alif_pattern = _pattern(ALIF_FORMS)
+hamza_pattern = _pattern(HAMZA_SEATS)
+alif_hamza_pattern = _pattern(HAMZA_SEATS + ALIF_HAMZA_SEATS)
+yaa_pattern = _pattern(ALIF_MAQSURA)
+harakat_pattern = _pattern(HARAKAT)
+tanwin_pattern = _pattern(TANWIN)
+shaddah_pattern = _pattern(SHADDAH)
+kashida_pattern = _pattern(KASHIDA)
+tashkil_pattern = _pattern(HARAKAT + TANWIN + SHADDAH + KASHIDA)
+
+def _translate(text, table):
+    """ applies a translate table, promoting plain (ascii) strings to unicode """
+    if isinstance(text, str):
+        text = unicode(text)
+    return text.translate(table)
+
+class Normalizer:
+    """
+    Normalizer compiled from one combination of normalize flags
+    Character mappings run as precompiled regexes after the charset filter,
+    with all tashkil removed by one pattern; normalize_batch merges
+    them into a single lookup table
+    Use get_normalizer to share instances between calls
+    """
+    def __init__(self, ar_only=True, digits=False, alif=True, hamza=True, yaa=True, tashkil=True):
+        self.flags = (ar_only, digits, alif, hamza, yaa, tashkil)
+        self.ar_only = ar_only
+
+        # none of the mappings produce a char that a later mapping consumes,
+        # so merging them keeps the result of applying them in sequence
+        self.steps = []
+        self.table = {}
+        if digits:
+            self.steps.append((digits_pattern, u'#'))
+            self.table.update(digits_table)
+        if alif:
+            self.steps.append((alif_pattern, u'ا'))
+            self.table.update(alif_table)
+        if hamza:
+            self.steps.append((hamza_pattern, u'ء'))
+            self.table.update(hamza_table)
+        if yaa:
+            self.steps.append((yaa_pattern, u'ي'))
+            self.table.update(yaa_table)
+        if tashkil:
+            self.steps.append((tashkil_pattern, u''))
+            self.table.update(tashkil_table)
+
+    def __call__(self, text):
+        return self.normalize(text)
+
+    def normalize(self, text):
+        # the charset filter must run first, it collapses runs around deleted tashkil
+        if self.ar_only:
+            text = inv_arabic_charset.sub(' ', text)
+
+        for pattern, replacement in self.steps:
+            text = pattern.sub(replacement, text)
+
+        return text
+
+    def normalize_batch(self, strings):
+        """
+        Normalizes a list of strings at once, returns the list of normalized strings
+        The strings are packed into one code point array and normalized with
+        lookup tables and masks, matching normalize on each string
+        """
+        if not strings:
+            return []
+
+        lengths = np.fromiter((len(string) for string in strings), dtype=np.int64, count=len(strings))
+        starts = np.zeros(len(strings), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=starts[1:])
+
+        points = np.frombuffer(u''.join(strings).encode(batch_codec), dtype=batch_dtype).astype(np.int32)
+        keep = np.ones(len(points), dtype=bool)
+
+        if self.ar_only:
+            # runs of non arabic chars become one space, runs end at string boundaries
+            outside = ~arabic_charset_lut[np.minimum(points, len(arabic_charset_lut) - 1)]
+            run = np.zeros(len(points), dtype=bool)
+            run[1:] = outside[:-1]
+            run[starts[lengths > 0]] = False
+
+            keep = ~(outside & run)
+            points[outside] = ord(u' ')
+
+        if self.table:
+            mapping, deleted = self._lookup_tables()
+
+            small = points < len(mapping)
+            index = np.where(small, points, 0)
+
+            keep &= ~(deleted[index] & small)
+            points = np.where(small, mapping[index], points)
+
+        # offsets of each string among the kept code points
+        kept = np.zeros(len(points) + 1, dtype=np.int64)
+        np.cumsum(keep, out=kept[1:])
+        new_starts = kept[starts]
+        new_ends = kept[starts + lengths]
+
+        text = points[keep].astype(batch_dtype).tostring().decode(batch_codec)
+
+        return [text[start:end] for start, end in zip(new_starts.tolist(), new_ends.tolist())]
+
+    def _lookup_tables(self):
+        """ code point mapping and deletion arrays built from the translate table """
+        if not hasattr(self, 'mapping'):
+            size = max(self.table) + 1
+            self.mapping = np.arange(size, dtype=np.int32)
+            self.deleted = np.zeros(size, dtype=bool)
+
+            for point, replacement in self.table.iteritems():
+                if replacement is None:
+                    self.deleted[point] = True
+                else:
+                    self.mapping[point] = ord(replacement)
+
+        return self.mapping, self.deleted
+
+# normalizers compiled so far, keyed by flag tuple
+normalizers = {}
+
+def get_normalizer(ar_only=True, digits=False, alif=True, hamza=True, yaa=True, tashkil=True):
+    """ returns the cached Normalizer for a combination of normalize flags """
+    flags = (bool(ar_only), bool(digits), bool(alif), bool(hamza), bool(yaa), bool(tashkil))
+
+    normalizer = normalizers.get(flags)
+    if normalizer is None:
+        normalizer = Normalizer(*flags)
+        normalizers[flags] = normalizer
+
+    return normalizer
+
 def normalize(text, ar_only=True, digits=False, alif=True, hamza=True, yaa=True, tashkil=True):
     """
     Normalizes arabic text
@@ -20,29 +223,33 @@ def normalize(text, ar_only=True, digits=False, alif=True, hamza=True, yaa=True,
     Normalizes alif, hamza, and yaa by default
     Removes supplementary diacritics
     """
-    if ar_only:
-        text = normalize_charset(text)
-
-    if digits:
-        text = normalize_digits(text)
-
-
-    if alif:
-        text = normalize_alif(text)
-    if hamza:
-        text = normalize_hamza(text)
-    if yaa:
-        text = normalize_yaa(text)
-
-    if tashkil:
-        text = remove_tashkil(text)
+    return get_normalizer(ar_only=ar_only, digits=digits, alif=alif, hamza=hamza, yaa=yaa, tashkil=tashkil)(text)
 
-    return text
+def normalize_batch(strings, ar_only=True, digits=False, alif=True, hamza=True, yaa=True, tashkil=True):
+    """
+    Normalizes a list of strings, for large vocabularies or lemma lists
+    Takes the same flags as normalize and gives the same result for each string
+    """
+    return get_normalizer(ar_only=ar_only, digits=digits, alif=alif, hamza=hamza, yaa=yaa, tashkil=tashkil).normalize_batch(strings)
 
-def normalize_sentence_file(sentence_file, outfile_path="normal.txt", ar_only=True, digits=True, alif=True, hamza=True, yaa=True, tashkil=True):
+def normalize_sentence_file(sentence_file, outfile_path="normal.txt", ar_only=True, digits=True, alif=True, hamza=True, yaa=True, tashkil=True,
+                            workers=1, shards=False, block_size=BLOCK_SIZE, checkpoint=False):
     """
     Normalizes a file of sentences and saves to a file w/ parameterized naming scheme
     returns the outfile name
+
+    workers > 1 normalizes newline aligned byte ranges of the file in a process pool,
+    the ranges are joined back into outfile_path in their original order
+    shards=True keeps one output per range (outfile_path.0, outfile_path.1, ...) instead
+    of joining them and writes a json manifest, returns the manifest name
+
+    the file is read, normalized and written in newline aligned blocks of about
+    block_size bytes, set block_size=0 to process it one line at a time
+
+    checkpoint=True normalizes the file in chunks cached under outfile_path.chunks,
+    named by the hash of their bytes and flags, with progress recorded in
+    outfile_path.checkpoint.json: an interrupted run resumes with the missing chunks,
+    and a rerun only normalizes the chunks that changed (or nothing if none did)
     """
 
     # outfile_path = (sentence_file.split('.')[0]+
@@ -54,25 +261,27 @@ def normalize_sentence_file(sentence_file, outfile_path="normal.txt", ar_only=Tr
     #                "_tashkil"+str(tashkil)+
     #                ".txt")
 
-    with open(sentence_file, 'r') as infile:
-        with open(outfile_path, 'w') as outfile:
-            for text in infile:
-                text = text.decode('utf8')
+    flags = (ar_only, digits, alif, hamza, yaa, tashkil)
 
-                text = normalize(text, ar_only=ar_only, digits=digits, alif=alif, hamza=hamza, yaa=yaa, tashkil=tashkil)
-                
-                if text:
-                    outfile.write(text.encode('utf8'))
+    if checkpoint:
+        if shards:
+            raise ValueError("shards are not supported with checkpoint")
+        return _normalize_sentence_file_checkpointed(sentence_file, outfile_path, flags, max(workers, 1), block_size)
+
+    if workers > 1 or shards:
+        return _normalize_sentence_file_ranges(sentence_file, outfile_path, flags, max(workers, 1), shards, block_size)
+
+    normalizer = get_normalizer(*flags)
+
+    with open(sentence_file, 'rb') as infile:
+        with open(outfile_path, 'wb') as outfile:
+            _normalize_stream(infile, outfile, normalizer, block_size=block_size)
 
     return outfile_path
 
 def remove_tashkil(text):
     """ removes set of arabic supplementary diacritics """
-    text = remove_harakat(text)
-    text = remove_tanwin(text)
-    text = remove_shaddah(text)
-    text = remove_kashida(text)
-    return text
+    return tashkil_pattern.sub(u'', text)
 
 #####################
 ### Normalization ###
@@ -83,15 +292,15 @@ def normalize_charset(text):
 
 def normalize_digits(text):
     """ replaces all forms of numbers with # """
-    return re.sub(ur'[0123456789٠١٢٣٤٥٦٧٨٩]', ur'#', text)
+    return digits_pattern.sub(u'#', text)
 
 def normalize_alif(text):
     """ replaces all forms of alif with ا """
-    return re.sub(ur'[إأٱآا]', ur'ا', text)
+    return alif_pattern.sub(u'ا', text)
 
 def normalize_yaa(text):
     """ replaces ى with ي """
-    return re.sub(ur'ى', ur'ي', text)
+    return yaa_pattern.sub(u'ي', text)
 
 def normalize_hamza(text, normalize_alif = False):
     """
@@ -100,9 +309,9 @@ def normalize_hamza(text, normalize_alif = False):
     set normalize_alif=True to replace إأ with hamza
     """
     if normalize_alif:
-        return re.sub(ur'[ؤئإأ]', ur'ء', text)
+        return alif_hamza_pattern.sub(u'ء', text)
     else:
-        return re.sub(ur'[ؤئ]', ur'ء', text)
+        return hamza_pattern.sub(u'ء', text)
 
 #######################
 ### Tashkil removal ###
@@ -112,111 +321,418 @@ def remove_harakat(text):
     """
     removes short vowel marks
     does not normalize alif forms
-    does not remove tanwin (ًٌٍ) (use remove_tanwin)
+    does not remove tanwin (ًٌٍ) (use remove_tanwin)
     """
-    return re.sub(ur'[َُِْ]', ur'', text)
+    return harakat_pattern.sub(u'', text)
 
 def remove_tanwin(text):
     """
     removes tanwin vowel marks
     does not normalize alif forms
     """
-    return re.sub(ur'[ًٌٍ]', ur'', text)
+    return tanwin_pattern.sub(u'', text)
 
 def remove_shaddah(text):
     """
     removes the shaddah mark (tashdid)
     """
-    return re.sub(ur'[ّ]', ur'', text)
+    return shaddah_pattern.sub(u'', text)
 
 def remove_kashida(text):
     """
     removes the kashida elongation mark (tatwil)
     """
-    return re.sub(ur'[ـ]', ur'', text)
+    return kashida_pattern.sub(u'', text)
+
+##########################
+### File normalization ###
+##########################
+
+def iter_blocks(infile, block_size=BLOCK_SIZE, end=None):
+    """
+    Yields the bytes of an open file in blocks of about block_size bytes
+    Every block but the last ends with a newline, lines longer than block_size are kept whole
+    Stops at byte offset end if given
+    """
+    position = infile.tell()
+    tail = b''
+
+    while end is None or position < end:
+        size = block_size if end is None else min(block_size, end - position)
+        data = infile.read(size)
+        if not data:
+            break
+        position += len(data)
+
+        data = tail + data
+        cut = data.rfind(b'\n') + 1
+
+        if cut:
+            tail = data[cut:]
+            yield data[:cut]
+        else:
+            tail = data
+
+    if tail:
+        yield tail
+
+def _normalize_stream(infile, outfile, normalizer, end=None, block_size=BLOCK_SIZE):
+    """
+    Normalizes the lines of an open file up to byte offset end into outfile
+    Lines that normalize to nothing are dropped, returns the number of lines written
+    """
+    lines = 0
+
+    if block_size:
+        # whole blocks give the same text as line by line normalization: the charset
+        # regex never matches across a newline, and only a last line without a
+        # newline can normalize to nothing
+        # blocks go through the vectorized batch path, translate with a dict
+        # costs a lookup per char and is slower than the regexes on long text
+        for data in iter_blocks(infile, block_size, end):
+            text = normalizer.normalize_batch([data.decode('utf8')])[0]
+
+            if text:
+                outfile.write(text.encode('utf8'))
+                lines += text.count('\n') + (not text.endswith('\n'))
+
+        return lines
+
+    position = infile.tell()
+
+    while end is None or position < end:
+        text = infile.readline()
+        if not text:
+            break
+        position += len(text)
+
+        text = normalizer(text.decode('utf8'))
+
+        if text:
+            outfile.write(text.encode('utf8'))
+            lines += 1
+
+    return lines
 
-    text = re.sub(noise, '', text)
-    return text
+###################################
+### Parallel file normalization ###
+###################################
+
+def file_ranges(path, count):
+    """
+    Splits a file into at most count (start, end) byte ranges of similar size
+    Every range starts at the beginning of a line
+    """
+    size = os.path.getsize(path)
+    bounds = [0]
+
+    with open(path, 'rb') as infile:
+        for i in range(1, count):
+            offset = max(size * i // count, bounds[-1])
+
+            # move to the start of the first line beginning at or after offset
+            if offset > 0:
+                infile.seek(offset - 1)
+                infile.readline()
+                offset = infile.tell()
+
+            bounds.append(min(offset, size))
+
+    bounds.append(size)
+
+    return [(start, end) for start, end in zip(bounds, bounds[1:]) if end > start]
+
+def _normalize_range(args):
+    """ pool worker, normalizes one byte range of a sentence file into its own file """
+    sentence_file, start, end, outfile_path, flags, block_size = args
+
+    with open(sentence_file, 'rb') as infile:
+        with open(outfile_path, 'wb') as outfile:
+            infile.seek(start)
+            lines = _normalize_stream(infile, outfile, get_normalizer(*flags), end, block_size)
+            size = outfile.tell()
+
+    return {"path": outfile_path, "start": start, "end": end, "lines": lines, "bytes": size}
+
+def _normalize_sentence_file_ranges(sentence_file, outfile_path, flags, workers, shards, block_size):
+    """ normalizes a sentence file range by range in a process pool """
+    ranges = file_ranges(sentence_file, workers)
+    jobs = [(sentence_file, start, end, outfile_path+"."+str(i), flags, block_size) for i, (start, end) in enumerate(ranges)]
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        results = pool.map(_normalize_range, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    if shards:
+        manifest_path = outfile_path+".manifest.json"
+        manifest = {"source": sentence_file,
+                    "flags": dict(zip(FLAG_NAMES, flags)),
+                    "shards": results}
+
+        with open(manifest_path, 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent=2)
+
+        return manifest_path
+
+    # stitch the ranges back together in input order
+    with open(outfile_path, 'wb') as outfile:
+        for result in results:
+            with open(result["path"], 'rb') as shard:
+                shutil.copyfileobj(shard, outfile)
+            os.remove(result["path"])
+
+    return outfile_path
+
+#######################################
+### Checkpointed file normalization ###
+#######################################
+
+def _normalize_sentence_file_checkpointed(sentence_file, outfile_path, flags, workers, block_size):
+    """ normalizes a sentence file through a cache of normalized chunks """
+    manifest_path = outfile_path+".checkpoint.json"
+    chunk_dir = outfile_path+".chunks"
+
+    stat = os.stat(sentence_file)
+    source = {"path": sentence_file, "size": stat.st_size, "mtime": stat.st_mtime}
+    flag_set = dict(zip(FLAG_NAMES, flags))
+
+    # nothing to do if the last run finished on the same input with the same flags
+    manifest = util.load_json(manifest_path)
+    if (manifest and manifest.get("complete") and manifest["source"] == source and manifest["flags"] == flag_set
+            and os.path.exists(outfile_path) and os.path.getsize(outfile_path) == manifest["bytes"]):
+        return outfile_path
+
+    if not os.path.isdir(chunk_dir):
+        os.makedirs(chunk_dir)
+
+    # chunk the input, chunks are keyed by their content and the flags
+    chunks = []
+    with open(sentence_file, 'rb') as infile:
+        start = 0
+        for data in iter_blocks(infile, CHUNK_SIZE):
+            digest = hashlib.sha1(repr(flags))
+            digest.update(data)
+
+            key = digest.hexdigest()
+            chunks.append({"start": start, "end": start + len(data), "hash": key,
+                           "done": os.path.exists(os.path.join(chunk_dir, key))})
+            start += len(data)
+
+    manifest = {"source": source, "flags": flag_set, "chunks": chunks, "complete": False}
+    util.save_json(manifest, manifest_path)
+
+    # normalize the chunks that are not cached yet, recording each one as it lands
+    jobs = {}
+    for chunk in chunks:
+        if not chunk["done"] and chunk["hash"] not in jobs:
+            jobs[chunk["hash"]] = (sentence_file, chunk["start"], chunk["end"],
+                                   os.path.join(chunk_dir, chunk["hash"]+".tmp"), flags, block_size)
+
+    pool = multiprocessing.Pool(workers) if workers > 1 and len(jobs) > 1 else None
+    try:
+        if pool:
+            results = pool.imap_unordered(_normalize_range, jobs.values())
+        else:
+            results = itertools.imap(_normalize_range, jobs.values())
+
+        for result in results:
+            key = os.path.basename(result["path"])[:-len(".tmp")]
+            os.rename(result["path"], os.path.join(chunk_dir, key))
+
+            for chunk in chunks:
+                if chunk["hash"] == key:
+                    chunk["done"] = True
+            util.save_json(manifest, manifest_path)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+
+    # join the chunks in input order
+    with open(outfile_path+".tmp", 'wb') as outfile:
+        for chunk in chunks:
+            with open(os.path.join(chunk_dir, chunk["hash"]), 'rb') as chunk_file:
+                shutil.copyfileobj(chunk_file, outfile)
+        size = outfile.tell()
+    os.rename(outfile_path+".tmp", outfile_path)
+
+    # drop cached chunks of older versions of the input
+    keys = set(chunk["hash"] for chunk in chunks)
+    for name in os.listdir(chunk_dir):
+        if name not in keys:
+            os.remove(os.path.join(chunk_dir, name))
+
+    manifest["complete"] = True
+    manifest["bytes"] = size
+    util.save_json(manifest, manifest_path)
+
+    return outfile_path
+
+###########################
+### Streaming pipelines ###
+###########################
+
+def read_lines(path):
+    """ yields the lines of a utf8 file as unicode, without newlines """
+    with open(path, 'rb') as infile:
+        for line in infile:
+            yield line.decode('utf8').rstrip(u'\n')
+
+def normalize_lines(lines, ar_only=True, digits=False, alif=True, hamza=True, yaa=True, tashkil=True):
+    """ yields each line normalized, takes the same flags as normalize """
+    normalizer = get_normalizer(ar_only=ar_only, digits=digits, alif=alif, hamza=hamza, yaa=yaa, tashkil=tashkil)
+    for line in lines:
+        yield normalizer(line)
+
+def fold_digits(lines):
+    """ yields each line with all forms of numbers replaced with # """
+    for line in lines:
+        yield digits_pattern.sub(u'#', line)
+
+def drop_empty(lines):
+    """ yields only the lines with some non-whitespace text """
+    for line in lines:
+        if line.strip():
+            yield line
+
+def split_lines(lines):
+    """ yields each line as a list of words, the sentence form word2vec trains on """
+    for line in lines:
+        yield line.split()
+
+def write_lines(lines, path):
+    """ writes lines to a utf8 file one per line, returns the file name """
+    with open(path, 'wb') as outfile:
+        for line in lines:
+            outfile.write(line.encode('utf8'))
+            outfile.write(b'\n')
+
+    return path
+
+class Pipeline:
+    """
+    Re-iterable chain of generator stages over a source
+    The source is a file path (read with read_lines) or any re-iterable of lines,
+    each stage is a function taking and returning an iterable
+    Every iteration reruns the stages from the source, so consumers that make several
+    passes (like word2vec.train_embeddings) never need an intermediate file, e.g.
+    Pipeline("wiki.txt", functools.partial(normalize_lines, digits=True), drop_empty, split_lines)
+    """
+    def __init__(self, source, *stages):
+        self.source = source
+        self.stages = stages
+
+    def __iter__(self):
+        if isinstance(self.source, basestring):
+            items = read_lines(self.source)
+        else:
+            items = iter(self.source)
+
+        for stage in self.stages:
+            items = stage(items)
+
+        return items
 
 ##################################
 ### Buckwalter transliteration ###
 ##################################
 
-def unicode_to_bw(string, reverse=0):
+# buckwalter char for each arabic char
+# Partially taken from https://github.com/andyroberts/buckwalter2unicode
+buck2uni = {"'": u"\u0621", # hamza-on-the-line
+            "|": u"\u0622", # madda
+            ">": u"\u0623", # hamza-on-'alif
+            "&": u"\u0624", # hamza-on-waaw
+            "<": u"\u0625", # hamza-under-'alif
+            "}": u"\u0626", # hamza-on-yaa'
+            "A": u"\u0627", # bare 'alif
+            "b": u"\u0628", # baa'
+            "p": u"\u0629", # taa' marbuuTa
+            "t": u"\u062A", # taa'
+            "v": u"\u062B", # thaa'
+            "j": u"\u062C", # jiim
+            "H": u"\u062D", # Haa'
+            "x": u"\u062E", # khaa'
+            "d": u"\u062F", # daal
+            "*": u"\u0630", # dhaal
+            "r": u"\u0631", # raa'
+            "z": u"\u0632", # zaay
+            "s": u"\u0633", # siin
+            "$": u"\u0634", # shiin
+            "S": u"\u0635", # Saad
+            "D": u"\u0636", # Daad
+            "T": u"\u0637", # Taa'
+            "Z": u"\u0638", # Zaa' (DHaa')
+            "E": u"\u0639", # cayn
+            "g": u"\u063A", # ghayn
+            "_": u"\u0640", # taTwiil
+            "f": u"\u0641", # faa'
+            "q": u"\u0642", # qaaf
+            "k": u"\u0643", # kaaf
+            "l": u"\u0644", # laam
+            "m": u"\u0645", # miim
+            "n": u"\u0646", # nuun
+            "h": u"\u0647", # haa'
+            "w": u"\u0648", # waaw
+            "Y": u"\u0649", # 'alif maqSuura
+            "y": u"\u064A", # yaa'
+            "F": u"\u064B", # fatHatayn
+            "N": u"\u064C", # Dammatayn
+            "K": u"\u064D", # kasratayn
+            "a": u"\u064E", # fatHa
+            "u": u"\u064F", # Damma
+            "i": u"\u0650", # kasra
+            "~": u"\u0651", # shaddah
+            "o": u"\u0652", # sukuun
+            "`": u"\u0670", # dagger 'alif
+            "{": u"\u0671", # waSla
+}
+
+# buckwalter variants, replacing the chars that are unsafe in xml,
+# or in xml, file names and regexes
+bw_variants = {"bw": {},
+               "xmlbw": {"<": "I", ">": "O", "&": "W"},
+               "safebw": {"'": "C", "|": "M", ">": "O", "&": "W", "<": "I",
+                          "}": "Q", "*": "V", "$": "c", "`": "e", "{": "L"},
+}
+
+# translate tables for each variant in both directions
+uni2bw_tables = {}
+bw2uni_tables = {}
+for scheme, variant in bw_variants.iteritems():
+    uni2bw_tables[scheme] = {}
+    bw2uni_tables[scheme] = {}
+    for bw, uni in buck2uni.iteritems():
+        bw = unicode(variant.get(bw, bw))
+        uni2bw_tables[scheme][ord(uni)] = bw
+        bw2uni_tables[scheme][ord(bw)] = uni
+
+def unicode_to_bw(string, reverse=0, scheme="bw"):
     """
     Given a Unicode string, transliterate into Buckwalter. 
     To go from Buckwalter back to Unicode, set reverse=1.
-    Partially taken from https://github.com/andyroberts/buckwalter2unicode
-    """
-
-    buck2uni = {"'": u"\u0621", # hamza-on-the-line
-                "|": u"\u0622", # madda
-                ">": u"\u0623", # hamza-on-'alif
-                "&": u"\u0624", # hamza-on-waaw
-                "<": u"\u0625", # hamza-under-'alif
-                "}": u"\u0626", # hamza-on-yaa'
-                "A": u"\u0627", # bare 'alif
-                "b": u"\u0628", # baa'
-                "p": u"\u0629", # taa' marbuuTa
-                "t": u"\u062A", # taa'
-                "v": u"\u062B", # thaa'
-                "j": u"\u062C", # jiim
-                "H": u"\u062D", # Haa'
-                "x": u"\u062E", # khaa'
-                "d": u"\u062F", # daal
-                "*": u"\u0630", # dhaal
-                "r": u"\u0631", # raa'
-                "z": u"\u0632", # zaay
-                "s": u"\u0633", # siin
-                "$": u"\u0634", # shiin
-                "S": u"\u0635", # Saad
-                "D": u"\u0636", # Daad
-                "T": u"\u0637", # Taa'
-                "Z": u"\u0638", # Zaa' (DHaa')
-                "E": u"\u0639", # cayn
-                "g": u"\u063A", # ghayn
-                "_": u"\u0640", # taTwiil
-                "f": u"\u0641", # faa'
-                "q": u"\u0642", # qaaf
-                "k": u"\u0643", # kaaf
-                "l": u"\u0644", # laam
-                "m": u"\u0645", # miim
-                "n": u"\u0646", # nuun
-                "h": u"\u0647", # haa'
-                "w": u"\u0648", # waaw
-                "Y": u"\u0649", # 'alif maqSuura
-                "y": u"\u064A", # yaa'
-                "F": u"\u064B", # fatHatayn
-                "N": u"\u064C", # Dammatayn
-                "K": u"\u064D", # kasratayn
-                "a": u"\u064E", # fatHa
-                "u": u"\u064F", # Damma
-                "i": u"\u0650", # kasra
-                "~": u"\u0651", # shaddah
-                "o": u"\u0652", # sukuun
-                "`": u"\u0670", # dagger 'alif
-                "{": u"\u0671", # waSla
-    }
-
-    # For a reverse transliteration (Unicode -> Buckwalter), a dictionary
-    # which is the reverse of the above buck2uni is essential.
-
-    uni2buck = {}
-
-    # Iterate through all the items in the buck2uni dict.
-    for (key, value) in buck2uni.iteritems():
-            # The value from buck2uni becomes a key in uni2buck, and vice
-            # versa for the keys.
-            uni2buck[value] = key
-
-    if not reverse:     
-        for k,v in buck2uni.iteritems():
-            string = string.replace(v,k)
-
-    else:     
-        for k,v in buck2uni.iteritems():
-            string = string.replace(k,v)
-
-    return string
+    scheme picks the variant: bw, xmlbw (xml safe) or safebw (safe buckwalter)
+    """
+    if not reverse:
+        return _translate(string, uni2bw_tables[scheme])
+    else:
+        return _translate(string, bw2uni_tables[scheme])
+
+def transliterate_file(infile_path, outfile_path, reverse=0, scheme="bw", block_size=BLOCK_SIZE):
+    """
+    Transliterates a utf8 file into Buckwalter one block at a time
+    reverse and scheme work as in unicode_to_bw
+    returns the outfile name
+    """
+    tables = bw2uni_tables if reverse else uni2bw_tables
+    table = tables[scheme]
 
+    with open(infile_path, 'rb') as infile:
+        with open(outfile_path, 'wb') as outfile:
+            for data in iter_blocks(infile, block_size):
+                outfile.write(data.decode('utf8').translate(table).encode('utf8'))
 
+    return outfile_path
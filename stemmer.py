@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+### Purpose: Arabic light stemming tools, a fast approximation of madamira lemmas
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import arapy.normalization as norm
+
+# affixes stripped by the light stemmer, written after normalization, each with
+# the fewest chars it has to leave behind: single letter proclitics are also
+# common root letters, so they only come off longer words
+PROCLITICS = {u'وال': 2, u'فال': 2, u'بال': 2, u'كال': 2, u'لل': 2, u'ال': 2,
+              u'و': 3, u'ف': 4, u'ب': 4, u'ك': 4, u'ل': 4}
+
+ENCLITICS = {u'هما': 2, u'كما': 2,
+             u'ها': 2, u'هم': 2, u'هن': 2, u'كم': 2, u'كن': 2, u'نا': 2,
+             u'ه': 2, u'ي': 2}
+
+SUFFIXES = {u'ان': 2, u'ات': 2, u'ون': 2, u'ين': 2, u'ية': 2,
+            u'ة': 2}
+
+class AffixTrie:
+    """
+    Char trie over a dict of affixes and the fewest chars each has to leave
+    Suffix tries are built over the reversed affixes and walked from the end of the word
+    """
+    def __init__(self, affixes, suffix=False):
+        self.suffix = suffix
+        self.root = {}
+
+        for affix, keep in affixes.iteritems():
+            if suffix:
+                affix = affix[::-1]
+
+            node = self.root
+            for char in affix:
+                node = node.setdefault(char, {})
+            node[None] = keep
+
+    def longest(self, word):
+        """ length of the longest affix of word that leaves enough chars """
+        node = self.root
+        longest = 0
+
+        chars = reversed(word) if self.suffix else iter(word)
+        for length, char in enumerate(chars, 1):
+            node = node.get(char)
+            if node is None:
+                break
+
+            if None in node and len(word) - length >= node[None]:
+                longest = length
+
+        return longest
+
+class LightStemmer:
+    """
+    Rule based light stemmer
+    Strips the longest enclitic, then the longest suffix, then the longest proclitic
+    from normalized words
+    Stems are remembered per surface form, corpora repeat most of their words
+    """
+    def __init__(self, proclitics=PROCLITICS, enclitics=ENCLITICS, suffixes=SUFFIXES):
+        self.proclitics = AffixTrie(proclitics)
+        self.enclitics = AffixTrie(enclitics, suffix=True)
+        self.suffixes = AffixTrie(suffixes, suffix=True)
+        self.stems = {}
+
+    def stem(self, word):
+        """ returns the stem of a normalized word """
+        stem = self.stems.get(word)
+
+        if stem is None:
+            stem = word
+
+            cut = self.enclitics.longest(stem)
+            if cut:
+                stem = stem[:-cut]
+
+            cut = self.suffixes.longest(stem)
+            if cut:
+                stem = stem[:-cut]
+
+            cut = self.proclitics.longest(stem)
+            if cut:
+                stem = stem[cut:]
+
+            self.stems[word] = stem
+
+        return stem
+
+    def stem_line(self, line):
+        """ returns a line of normalized words with each word stemmed """
+        return u' '.join([self.stem(word) for word in line.split()])
+
+def stem_lines(lines, stemmer=None):
+    """ yields each line of normalized words stemmed, a stage for normalization.Pipeline """
+    if stemmer is None:
+        stemmer = LightStemmer()
+
+    for line in lines:
+        yield stemmer.stem_line(line)
+
+def stem_sentence_file(sentence_file, outfile_path="stems.txt", stemmer=None, digits=True):
+    """
+    Normalizes and stems a file of sentences, one output line per non empty input line
+    returns the outfile name
+    """
+    lines = norm.read_lines(sentence_file)
+    lines = norm.normalize_lines(lines, digits=digits)
+    lines = norm.drop_empty(lines)
+    lines = stem_lines(lines, stemmer)
+
+    return norm.write_lines(lines, outfile_path)
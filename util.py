@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+### Purpose: Small helpers shared by the arapy modules
+
+from __future__ import absolute_import
+from __future__ import print_function
+
+import collections
+import json
+import os
+
+def ordered_map(pool, function, items, window):
+    """
+    Yields function(item) for each item, in order
+    With a pool, keeps at most window items in flight so the input is read as it is consumed
+    """
+    if pool is None:
+        for item in items:
+            yield function(item)
+        return
+
+    pending = collections.deque()
+    for item in items:
+        pending.append(pool.apply_async(function, (item,)))
+        if len(pending) >= window:
+            yield pending.popleft().get()
+
+    while pending:
+        yield pending.popleft().get()
+
+def load_json(path):
+    """ returns the json content of a file, or None if it is missing or unreadable """
+    try:
+        with open(path, 'r') as infile:
+            return json.load(infile)
+    except (IOError, ValueError):
+        return None
+
+def save_json(content, path):
+    """ writes json to a file atomically, readers see the old or the new content """
+    with open(path+".tmp", 'w') as outfile:
+        json.dump(content, outfile, indent=2)
+    os.rename(path+".tmp", path)
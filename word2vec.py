@@ -16,6 +16,8 @@ def train_embeddings(infile, outfile = "embedding.txt", sg=1, size=100, seed = 0
     """
     Saves the model to a file with the parameters in the name.
     All of these functions work on any language of corpora
+    infile is a sentence file path, or a re-iterable of word lists such as a
+    normalization.Pipeline ending in split_lines or a corpus.Corpus
     Uses gensim's training parameters:
 
     Initialize the model from an iterable of `sentences`. Each sentence is a
@@ -74,7 +76,10 @@ def train_embeddings(infile, outfile = "embedding.txt", sg=1, size=100, seed = 0
     #             yield line.split()
 
     # sentences = MySentences(infile)
-    sentences = LineSentence(infile)
+    if isinstance(infile, basestring):
+        sentences = LineSentence(infile)
+    else:
+        sentences = infile
 
     
     model = Word2Vec(sentences, 